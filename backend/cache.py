@@ -0,0 +1,148 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire after a per-entry TTL.
+    `lookup` can also hand back entries that expired less than
+    `stale_window` seconds ago, so callers can serve them while refreshing.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "evictions": 0}
+
+    def lookup(self, key, stale_window: float = 0):
+        """Return (value, "fresh" | "stale") or (None, None) on a miss"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None, None
+            value, expires_at = entry
+            age_past_expiry = time.monotonic() - expires_at
+            if age_past_expiry <= 0:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return value, "fresh"
+            if age_past_expiry <= stale_window:
+                self.entries.move_to_end(key)
+                self.stats["stale_hits"] += 1
+                return value, "stale"
+            del self.entries[key]
+            self.stats["misses"] += 1
+            return None, None
+
+    def get(self, key):
+        value, state = self.lookup(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        """Store `value`; without a ttl the entry only leaves by LRU eviction"""
+        with self.lock:
+            expires_at = time.monotonic() + ttl if ttl is not None else float("inf")
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["stale_hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hit_rate": round((self.stats["hits"] + self.stats["stale_hits"]) / lookups, 3) if lookups else 0.0
+            }
+
+
+class DiskCache:
+    """
+    Size-bounded on-disk tier for content-addressed values.
+    One file per key (sharded by the first two hex chars), written atomically.
+    Reads refresh the file's mtime, and when the directory grows past
+    `max_bytes` the least recently used files are removed until it is back
+    under 90% of the limit.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(os.path.getsize(path) for path, _ in self._files())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _files(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".tmp"):
+                    path = os.path.join(root, name)
+                    yield path, os.path.getmtime(path)
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return data
+
+    def locate(self, key: str):
+        """Path of the cached file (for streaming it), or None; counts as a read"""
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return path
+
+    def set(self, key: str, data: bytes) -> str:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        with self.lock:
+            if os.path.exists(path):
+                self.size -= os.path.getsize(path)
+            os.replace(tmp, path)
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self._evict()
+        return path
+
+    def _evict(self):
+        """Drop least recently used files until under 90% of the limit (lock held)"""
+        for path, _ in sorted(self._files(), key=lambda item: item[1]):
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                self.size -= os.path.getsize(path)
+                os.remove(path)
+                self.stats["evictions"] += 1
+            except OSError:
+                pass
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "size_mb": round(self.size / 1024 / 1024, 1), "max_mb": round(self.max_bytes / 1024 / 1024, 1)}
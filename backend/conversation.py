@@ -0,0 +1,98 @@
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, List
+
+from database import db_manager
+
+
+class ConversationStore:
+    """
+    Server-side conversation state.
+    The most recent turns of each (user, conversation) are kept in an
+    LRU-bounded in-memory cache, loaded from the database on first use and
+    appended to as new messages are recorded. build_context() assembles the turns that fit a
+    model's token budget, newest first, and folds the older ones into a
+    one-line summary instead of silently dropping them.
+    """
+
+    def __init__(self, db, max_conversations: int = 1000, turns_per_conversation: int = 40):
+        self.db = db
+        self.max_conversations = max_conversations
+        self.turns_per_conversation = turns_per_conversation
+        self.conversations = OrderedDict()
+        self.lock = threading.Lock()
+
+    def recent(self, user_id: str, conversation_id: str) -> List[dict]:
+        """Cached recent turns of one conversation (oldest first)"""
+        key = (user_id, conversation_id)
+        with self.lock:
+            if key in self.conversations:
+                self.conversations.move_to_end(key)
+                return list(self.conversations[key])
+
+        rows = self.db.get_history(user_id, limit=self.turns_per_conversation, conversation_id=conversation_id)
+        turns = deque(
+            ({"role": row["role"], "content": row["content"]} for row in rows),
+            maxlen=self.turns_per_conversation
+        )
+        with self.lock:
+            # A message recorded while we were loading wins over the DB snapshot
+            turns = self.conversations.setdefault(key, turns)
+            self.conversations.move_to_end(key)
+            while len(self.conversations) > self.max_conversations:
+                self.conversations.popitem(last=False)
+            return list(turns)
+
+    def record(self, user_id: str, conversation_id: str, role: str, content: str, model_used: str):
+        """Append a turn to the cache and queue it for persistence"""
+        key = (user_id, conversation_id)
+        with self.lock:
+            if key in self.conversations:
+                self.conversations[key].append({"role": role, "content": content})
+        self.db.enqueue_message(user_id, role, content, model_used, conversation_id)
+
+    @staticmethod
+    def _summarize(turns: List[dict], max_chars: int) -> str:
+        """Extractive summary: the gist of each earlier user question"""
+        topics = []
+        for turn in turns:
+            if turn["role"] != "user":
+                continue
+            text = " ".join(turn["content"].split())
+            first_sentence = text.split(". ")[0].split("? ")[0]
+            topics.append(first_sentence[:80])
+        summary = "Earlier in this conversation the user asked about: " + "; ".join(topics)
+        return summary[:max_chars]
+
+    def build_context(self, history: List[dict], budget_tokens: int, count_tokens: Callable) -> List[dict]:
+        """Newest turns that fit in `budget_tokens`, with older ones summarized"""
+        if budget_tokens <= 0 or not history:
+            return []
+
+        # Keep ~15% of the budget for the summary of anything we drop
+        remaining = int(budget_tokens * 0.85)
+        kept = []
+        for index in range(len(history) - 1, -1, -1):
+            cost = count_tokens(history[index]["content"]) + 8  # role/template tokens
+            if cost > remaining:
+                break
+            kept.append(history[index])
+            remaining -= cost
+        kept.reverse()
+
+        dropped = history[:len(history) - len(kept)]
+        if any(turn["role"] == "user" for turn in dropped):
+            summary_budget = budget_tokens - (int(budget_tokens * 0.85) - remaining)
+            summary = self._summarize(dropped, max_chars=max(0, summary_budget * 3))
+            if summary and count_tokens(summary) + 8 <= summary_budget:
+                kept.insert(0, {"role": "system", "content": summary})
+        return kept
+
+
+# Create global instance
+conversation_store = ConversationStore(
+    db_manager,
+    max_conversations=int(os.getenv("CONVERSATION_CACHE_SIZE", "1000")),
+    turns_per_conversation=int(os.getenv("CONVERSATION_CACHE_TURNS", "40"))
+)
@@ -1,50 +1,105 @@
 import os
+from datetime import datetime, timezone
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
+from services import LazyService
+from write_behind import WriteBehindQueue
+
 load_dotenv()
 
 class DatabaseManager:
-    def __init__(self):
+    def __init__(self, client=None):
         url = os.environ.get("SUPABASE_URL")
         key = os.environ.get("SUPABASE_KEY")
-        if url and key:
+        if client is not None:
+            self.supabase = client
+        elif url and key:
             self.supabase: Client = create_client(url, key)
         else:
             self.supabase = None
             print("Warning: Supabase credentials missing. Database functionality will be disabled.")
 
-    def store_message(self, user_id: str, role: str, content: str, model_used: str):
-        if not self.supabase:
+        self.writer = None
+        if self.supabase:
+            self.writer = WriteBehindQueue(
+                self._insert_batch,
+                journal_path=os.environ.get("MESSAGE_JOURNAL_PATH", "message_journal.jsonl"),
+                batch_size=int(os.environ.get("MESSAGE_BATCH_SIZE", "50")),
+                flush_interval=float(os.environ.get("MESSAGE_FLUSH_SECONDS", "2"))
+            )
+
+    def _insert_batch(self, rows: list):
+        # Rows carry conversation_id; older tables need the column from schema.sql
+        self.supabase.table("messages").insert(rows).execute()
+
+    def enqueue_message(self, user_id: str, role: str, content: str, model_used: str, conversation_id: str = None):
+        """Queue a message for a batched background insert (returns immediately)"""
+        if not self.writer:
             return None
-        
-        data = {
+
+        self.writer.put({
             "user_id": user_id,
+            "conversation_id": conversation_id,
             "role": role,
             "content": content,
-            "model_used": model_used
-        }
-        return self.supabase.table("messages").insert(data).execute()
+            "model_used": model_used,
+            # Stamped now so ordering survives the delayed insert
+            "created_at": datetime.now(timezone.utc).isoformat()
+        })
 
-    def get_history(self, user_id: str):
+    def shutdown(self):
+        """Drain queued messages before the process exits"""
+        if self.writer:
+            self.writer.close()
+
+    def get_write_stats(self) -> dict:
+        return self.writer.get_stats() if self.writer else {}
+
+    def get_history(self, user_id: str, limit: int = 50, before: str = None, conversation_id: str = None) -> list:
+        """
+        Most recent `limit` messages of a user (or of one of their conversations), oldest first.
+        Pass the created_at of the oldest message you have as `before` to page back.
+        """
         if not self.supabase:
             return []
         
-        # History is fetched from the last 24 hours
-        return self.supabase.table("messages")\
-            .select("*")\
-            .eq("user_id", user_id)\
-            .order("created_at", desc=False)\
-            .execute()
-
-    def cleanup_old_messages(self):
+        query = self.supabase.table("messages")\
+            .select("role, content, model_used, created_at")\
+            .eq("user_id", user_id)
+        if conversation_id:
+            query = query.eq("conversation_id", conversation_id)
+        if before:
+            query = query.lt("created_at", before)
+        response = query.order("created_at", desc=True).limit(limit).execute()
+        return list(reversed(response.data or []))
+
+    def delete_expired_batch(self, cutoff: str, batch_size: int, user_id: str = None, model_used: str = None,
+                             exclude_users: list = (), exclude_models: list = ()) -> int:
+        """
+        Delete up to `batch_size` of the oldest messages created before `cutoff`
+        (ISO timestamp), optionally scoped to one user or model. Returns the
+        number of rows deleted; each call is one short select + delete by id.
+        """
         if not self.supabase:
-            return None
+            return 0
+        
+        query = self.supabase.table("messages")\
+            .select("id")\
+            .lt("created_at", cutoff)
+        if user_id:
+            query = query.eq("user_id", user_id)
+        if model_used:
+            query = query.eq("model_used", model_used)
+        if exclude_users:
+            query = query.not_.in_("user_id", list(exclude_users))
+        if exclude_models:
+            query = query.not_.in_("model_used", list(exclude_models))
+        rows = query.order("created_at", desc=False).limit(batch_size).execute().data or []
+        if not rows:
+            return 0
         
-        # This can be called by a cron job
-        # In SQL: DELETE FROM messages WHERE created_at < NOW() - INTERVAL '1 day';
-        # We can trigger an RPC or just use a raw delete if Supabase client allows it
-        # Here we'll just mock it or provide instructions for Supabase edge functions
-        pass
+        self.supabase.table("messages").delete().in_("id", [row["id"] for row in rows]).execute()
+        return len(rows)
 
-db_manager = DatabaseManager()
+db_manager = LazyService("db_manager", DatabaseManager)
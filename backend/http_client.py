@@ -0,0 +1,189 @@
+import os
+import time
+import random
+import threading
+import logging
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised without touching the network while a host's circuit is open"""
+
+
+class CircuitBreaker:
+    """
+    Per-host breaker: after `failure_threshold` consecutive failures the
+    host is skipped for `reset_timeout` seconds, then a single trial request
+    is let through to decide whether to close the circuit again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def release_trial(self):
+        """The trial ended without saying anything about the host; let the next one through"""
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class HTTPClient:
+    """
+    Shared outbound HTTP layer for tools, model downloads and image backends.
+    One pooled keep-alive session, a cap on concurrent requests per host,
+    jittered exponential backoff on timeouts/connection errors/5xx, and a
+    circuit breaker per host. GET/HEAD are retried by default; other methods
+    only when the caller passes `retries`.
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=int(os.getenv("HTTP_POOL_HOSTS", "32")),
+            pool_maxsize=int(os.getenv("HTTP_POOL_SIZE", "16"))
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.max_per_host = int(os.getenv("HTTP_MAX_PER_HOST", "16"))
+        self.retries = int(os.getenv("HTTP_RETRIES", "2"))
+        self.backoff = float(os.getenv("HTTP_BACKOFF_SECONDS", "0.25"))
+        self.failure_threshold = int(os.getenv("HTTP_BREAKER_FAILURES", "5"))
+        self.reset_timeout = float(os.getenv("HTTP_BREAKER_RESET_SECONDS", "30"))
+        self.breakers = {}
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def _host_state(self, url: str):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                self.semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return host, self.breakers[host], self.semaphores[host]
+
+    def _retry_delay(self, attempt: int, deadline: float = None):
+        """Jittered backoff before the next attempt, or None when the deadline leaves no room for one"""
+        delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def request(self, method: str, url: str, retries: int = None, deadline: float = None,
+                **kwargs) -> requests.Response:
+        """
+        `deadline` (a time.monotonic() value) bounds the whole call, retries and
+        backoff included: each attempt's timeout is cut to the time left.
+        """
+        host, breaker, semaphore = self._host_state(url)
+        if retries is None:
+            retries = self.retries if method.upper() in ("GET", "HEAD") else 0
+        timeout = kwargs.get("timeout")
+
+        for attempt in range(retries + 1):
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise requests.exceptions.Timeout(f"{method} {host}: deadline passed")
+                kwargs["timeout"] = min(timeout, remaining) if isinstance(timeout, (int, float)) else remaining
+            if not breaker.allow():
+                raise CircuitOpenError(f"Circuit open for {host}, skipping request")
+            try:
+                with semaphore:
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                breaker.record_failure()
+                delay = self._retry_delay(attempt, deadline) if attempt < retries else None
+                if delay is None:
+                    raise
+                logger.warning(f"{method} {host} failed ({type(e).__name__}), retrying")
+                time.sleep(delay)
+                continue
+            except requests.exceptions.RequestException:
+                # Broken bodies, redirect loops, bad URLs: not retried, but the outcome is recorded
+                # so a half-open trial never stays in flight forever
+                breaker.record_failure()
+                raise
+            except BaseException:
+                breaker.release_trial()
+                raise
+
+            if response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if response.status_code in RETRY_STATUSES and attempt < retries:
+                delay = self._retry_delay(attempt, deadline)
+                if delay is not None:
+                    logger.warning(f"{method} {host} returned {response.status_code}, retrying")
+                    response.close()
+                    time.sleep(delay)
+                    continue
+            return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        return self.request("HEAD", url, **kwargs)
+
+    def host_available(self, url: str) -> bool:
+        """False while the circuit for this URL's host is open"""
+        host, breaker, _ = self._host_state(url)
+        return breaker.state != "open"
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            breakers = dict(self.breakers)
+        return {
+            host: {"state": breaker.state, "consecutive_failures": breaker.failures}
+            for host, breaker in breakers.items()
+        }
+
+
+# Create global instance
+http_client = HTTPClient()
@@ -1,8 +1,16 @@
 import os
+import time
 import requests
-from typing import Optional
+import threading
+from typing import Optional, Callable
 import json
 
+from services import LazyService
+from http_client import http_client
+
+# Failover order: local first, then hosted APIs
+BACKEND_PREFERENCE = ["ollama", "huggingface", "openai"]
+
 class ImageGenerator:
     def __init__(self):
         """
@@ -13,30 +21,88 @@ class ImageGenerator:
         - OpenAI DALL-E (requires API key)
         """
         self.ollama_url = os.getenv("OLLAMA_URL", "http://localhost:11434")
+        self.ollama_model = os.getenv("OLLAMA_IMAGE_MODEL", "stable-diffusion")
         self.hf_api_key = os.getenv("HF_API_KEY", "")
         self.openai_api_key = os.getenv("OPENAI_API_KEY", "")
-        self.backend = self._detect_backend()
-        
+        self.hf_api_url = "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-2"
+        self.openai_api_url = "https://api.openai.com/v1/images/generations"
+        self.backend = None
+        self.detected = False
+
+        # Health snapshot kept fresh by a background thread; status calls read it from memory
+        self.health_interval = float(os.getenv("IMAGE_HEALTH_INTERVAL_SECONDS", "30"))
+        self.health = {}
+        self.health_checked_at = None
+        self.health_lock = threading.Lock()
+        self.monitor_stop = threading.Event()
+        self.monitor = None
+        # Startup warm-up and the first image job can both call warmup()
+        self.warmup_lock = threading.Lock()
+
+    def warmup(self):
+        """Probe backends once and start the health monitor (run in the background at startup)"""
+        with self.warmup_lock:
+            if self.detected:
+                return
+            self.backend = self._detect_backend()
+            self.detected = True
+            if self.monitor is None and self.health_interval > 0:
+                self.monitor = threading.Thread(target=self._monitor_loop, name="image-health", daemon=True)
+                self.monitor.start()
+
+    def _monitor_loop(self):
+        while not self.monitor_stop.wait(self.health_interval):
+            try:
+                self.refresh_health()
+            except Exception as e:
+                print(f"Image backend health check failed: {e}")
+
+    def _probe(self, name: str) -> dict:
+        """One backend's health: configured, reachable (Ollama) or not circuit-broken (APIs)"""
+        start = time.monotonic()
+        try:
+            if name == "ollama":
+                response = http_client.get(f"{self.ollama_url}/api/tags", timeout=2, retries=0)
+                available = response.status_code == 200
+                error = None if available else f"HTTP {response.status_code}"
+            elif name == "huggingface":
+                available = bool(self.hf_api_key) and http_client.host_available(self.hf_api_url)
+                error = None if available else ("HF_API_KEY not set" if not self.hf_api_key else "circuit open")
+            else:
+                available = bool(self.openai_api_key) and http_client.host_available(self.openai_api_url)
+                error = None if available else ("OPENAI_API_KEY not set" if not self.openai_api_key else "circuit open")
+        except Exception as e:
+            available, error = False, type(e).__name__
+        return {
+            "available": available,
+            "error": error,
+            "latency_ms": round((time.monotonic() - start) * 1000, 1)
+        }
+
+    def refresh_health(self) -> Optional[str]:
+        """Re-probe every backend and fail over to the first healthy one (ollama > huggingface > openai)"""
+        health = {name: self._probe(name) for name in BACKEND_PREFERENCE}
+        backend = next((name for name in BACKEND_PREFERENCE if health[name]["available"]), None)
+        with self.health_lock:
+            self.health = health
+            self.health_checked_at = time.time()
+            if backend != self.backend:
+                print(f"Image generation backend: {self.backend or 'none'} -> {backend or 'none'}")
+            self.backend = backend
+        return backend
+
     def _detect_backend(self) -> str:
         """Detect which image generation backend is available"""
-        # Check Ollama first (local)
-        try:
-            response = requests.get(f"{self.ollama_url}/api/tags", timeout=2)
-            if response.status_code == 200:
-                print("✓ Image generation: Ollama detected")
-                return "ollama"
-        except:
-            pass
-        
-        # Check Hugging Face
-        if self.hf_api_key:
+        backend = self.refresh_health()
+        if backend == "ollama":
+            print("✓ Image generation: Ollama detected")
+            return backend
+        if backend == "huggingface":
             print("✓ Image generation: Hugging Face API ready")
-            return "huggingface"
-        
-        # Check OpenAI
-        if self.openai_api_key:
+            return backend
+        if backend == "openai":
             print("✓ Image generation: OpenAI DALL-E ready")
-            return "openai"
+            return backend
         
         print("⚠ No image generation backend available")
         print("  Install options:")
@@ -45,44 +111,80 @@ class ImageGenerator:
         print("  3. OpenAI: Set OPENAI_API_KEY environment variable")
         return None
 
-    def generate(self, prompt: str, width: int = 512, height: int = 512, steps: int = 20) -> Optional[str]:
-        """Generate image from text prompt"""
+    def generate(self, prompt: str, width: int = 512, height: int = 512, steps: int = 20,
+                 progress: Callable[[float], None] = None) -> Optional[str]:
+        """Generate image from text prompt; `progress` gets 0..1 updates where the backend reports them"""
+        if not self.detected:
+            self.warmup()
         if not self.backend:
             return {"error": "No image generation backend configured"}
         
+        backend = self.backend
+        result = self._generate_with(backend, prompt, width, height, steps, progress)
+        if "error" in result:
+            # The backend may have just gone down: re-probe now rather than at the next tick
+            fallback = self.refresh_health()
+            if fallback and fallback != backend:
+                print(f"Image generation on {backend} failed, retrying on {fallback}")
+                backend = fallback
+                result = self._generate_with(backend, prompt, width, height, steps, progress)
+        if "error" not in result:
+            # Which backend actually produced the image (it changes on failover)
+            result["backend"] = backend
+        return result
+
+    def _generate_with(self, backend: str, prompt: str, width: int, height: int, steps: int,
+                       progress: Callable[[float], None] = None) -> dict:
         try:
-            if self.backend == "ollama":
-                return self._generate_ollama(prompt, width, height, steps)
-            elif self.backend == "huggingface":
+            if backend == "ollama":
+                return self._generate_ollama(prompt, width, height, steps, progress)
+            elif backend == "huggingface":
                 return self._generate_huggingface(prompt)
-            elif self.backend == "openai":
+            elif backend == "openai":
                 return self._generate_openai(prompt)
         except Exception as e:
             return {"error": str(e)}
+        return {"error": "No image generation backend configured"}
 
-    def _generate_ollama(self, prompt: str, width: int, height: int, steps: int) -> dict:
-        """Generate image using Ollama + Stable Diffusion"""
+    def _generate_ollama(self, prompt: str, width: int, height: int, steps: int,
+                         progress: Callable[[float], None] = None) -> dict:
+        """Generate image using Ollama + Stable Diffusion (streamed, for step progress)"""
         try:
-            response = requests.post(
+            response = http_client.post(
                 f"{self.ollama_url}/api/generate",
                 json={
-                    "model": "stable-diffusion",
+                    "model": self.ollama_model,
                     "prompt": prompt,
-                    "stream": False
+                    "width": width,
+                    "height": height,
+                    "steps": steps,
+                    "stream": True
                 },
+                stream=True,
                 timeout=300  # 5 minute timeout for image generation
             )
             
-            if response.status_code == 200:
-                data = response.json()
-                return {
-                    "status": "success",
-                    "image": data.get("images", [""])[0],
-                    "prompt": prompt,
-                    "generator": "Ollama + Stable Diffusion"
-                }
-            else:
+            if response.status_code != 200:
                 return {"error": f"Ollama error: {response.text}"}
+
+            # NDJSON: {"completed": n, "total": m} while running, the image(s) at the end
+            image = ""
+            with response:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    if data.get("error"):
+                        return {"error": f"Ollama error: {data['error']}"}
+                    if progress and data.get("total"):
+                        progress(min(1.0, data.get("completed", 0) / data["total"]))
+                    image = data.get("image") or (data.get("images") or [image])[0]
+            return {
+                "status": "success",
+                "image": image,
+                "prompt": prompt,
+                "generator": "Ollama + Stable Diffusion"
+            }
         except requests.exceptions.ConnectionError:
             return {"error": "Ollama not running. Start Ollama first: ollama serve"}
 
@@ -90,9 +192,7 @@ class ImageGenerator:
         """Generate image using Hugging Face API"""
         try:
             headers = {"Authorization": f"Bearer {self.hf_api_key}"}
-            api_url = "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-2"
-            
-            response = requests.post(api_url, headers=headers, json={"inputs": prompt})
+            response = http_client.post(self.hf_api_url, headers=headers, json={"inputs": prompt}, timeout=120, retries=1)
             
             if response.status_code == 200:
                 return {
@@ -128,30 +228,20 @@ class ImageGenerator:
             return {"error": str(e)}
 
     def get_status(self) -> dict:
-        """Get current image generation status"""
+        """Get current image generation status (from the last health check, no I/O)"""
+        with self.health_lock:
+            health = dict(self.health)
+            checked_at = self.health_checked_at
         return {
             "backend": self.backend or "none",
-            "available_backends": self._get_available_backends(),
-            "status": "ready" if self.backend else "not_configured"
+            "available_backends": [name for name in BACKEND_PREFERENCE if health.get(name, {}).get("available")],
+            "status": "ready" if self.backend else ("not_configured" if self.detected else "detecting"),
+            "checked_at": checked_at,
+            "backends": health
         }
 
-    def _get_available_backends(self) -> list:
-        """List all available image generation backends"""
-        available = []
-        
-        try:
-            requests.get(f"{self.ollama_url}/api/tags", timeout=2)
-            available.append("ollama")
-        except:
-            pass
-        
-        if self.hf_api_key:
-            available.append("huggingface")
-        
-        if self.openai_api_key:
-            available.append("openai")
-        
-        return available
+    def shutdown(self):
+        self.monitor_stop.set()
 
 # Create global instance
-image_generator = ImageGenerator()
+image_generator = LazyService("image_generator", ImageGenerator, warmup="warmup")
@@ -0,0 +1,247 @@
+import os
+import time
+import uuid
+import base64
+import asyncio
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from image_generator import image_generator
+from image_store import image_store
+from http_client import http_client
+
+logger = logging.getLogger(__name__)
+
+
+class ImageQueueFullError(Exception):
+    """Too many image jobs are already queued"""
+
+
+class ImageJob:
+    """One image generation request; progress is pushed to subscribed event loops"""
+
+    def __init__(self, key: str, prompt: str, width: int, height: int, steps: int):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.prompt = prompt
+        self.width = width
+        self.height = height
+        self.steps = steps
+        self.status = "queued"
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.future = None
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def subscribe(self, loop: asyncio.AbstractEventLoop) -> asyncio.Queue:
+        """Queue receiving a snapshot on every change; primed with the current one"""
+        events = asyncio.Queue()
+        with self._lock:
+            events.put_nowait(self.to_dict())
+            if not self.finished:
+                self._subscribers.append((loop, events))
+        return events
+
+    def unsubscribe(self, events: asyncio.Queue):
+        with self._lock:
+            self._subscribers = [(loop, queue) for loop, queue in self._subscribers if queue is not events]
+
+    def update(self, **changes):
+        with self._lock:
+            for name, value in changes.items():
+                setattr(self, name, value)
+            snapshot = self.to_dict()
+            subscribers = list(self._subscribers)
+            if self.finished:
+                self._subscribers = []
+        for loop, events in subscribers:
+            loop.call_soon_threadsafe(events.put_nowait, snapshot)
+
+    def to_dict(self) -> dict:
+        job = {
+            "job_id": self.id,
+            "status": self.status,
+            "progress": round(self.progress, 3),
+            "prompt": self.prompt,
+            "width": self.width,
+            "height": self.height,
+            "steps": self.steps,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+        if self.error:
+            job["error"] = self.error
+        if self.result is not None:
+            job["result"] = self.result
+        return job
+
+
+class ImageJobQueue:
+    """
+    Runs image generation on a small worker pool instead of the request.
+    submit() returns immediately with a job that can be polled or followed
+    as a stream of progress snapshots. Identical prompt+size+steps requests
+    that arrive while one is queued or running share that job, and images
+    already in the store finish without generating. Results point at
+    /images/{key} rather than carrying the image. Finished jobs are kept
+    for IMAGE_JOB_TTL_SECONDS so clients can collect them.
+    """
+
+    def __init__(self, generator, store, workers: int = 2, max_queue: int = 32, job_ttl: float = 3600):
+        self.generator = generator
+        self.store = store
+        self.max_queue = max_queue
+        self.job_ttl = job_ttl
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-job")
+        self.jobs = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.stats = {"submitted": 0, "deduplicated": 0, "completed": 0, "failed": 0, "rejected": 0, "from_store": 0}
+
+    @staticmethod
+    def job_key(prompt: str, width: int, height: int, steps: int) -> str:
+        return hashlib.sha256(f"{prompt}\x00{width}x{height}\x00{steps}".encode()).hexdigest()
+
+    def submit(self, prompt: str, width: int = 512, height: int = 512, steps: int = 20):
+        """Returns (job, deduplicated); raises ImageQueueFullError when saturated"""
+        key = self.job_key(prompt, width, height, steps)
+        with self.lock:
+            self._prune()
+            existing = self.in_flight.get(key)
+            if existing is not None:
+                self.stats["deduplicated"] += 1
+                return existing, True
+            if len(self.in_flight) >= self.max_queue:
+                self.stats["rejected"] += 1
+                raise ImageQueueFullError(f"{len(self.in_flight)} image jobs already queued")
+
+            job = ImageJob(key, prompt, width, height, steps)
+            self.jobs[job.id] = job
+            self.stats["submitted"] += 1
+
+            # Already generated: answer from the store without queueing behind running jobs
+            if self.generator.detected and self.generator.backend:
+                store_key = self.store.key(prompt, width, height, steps, self.generator.backend)
+                if self.store.lookup(store_key):
+                    self._finish(job, self._stored_result(job, store_key, self.generator.backend, cached=True))
+                    job.future = Future()
+                    job.future.set_result(job)
+                    return job, False
+
+            self.in_flight[key] = job
+            job.future = self.executor.submit(self._run, job)
+            return job, False
+
+    def _run(self, job: ImageJob):
+        job.update(status="running")
+        try:
+            if not self.generator.detected:
+                self.generator.warmup()
+            backend = self.generator.backend
+            store_key = self.store.key(job.prompt, job.width, job.height, job.steps, backend)
+            if backend and self.store.lookup(store_key):
+                result = self._stored_result(job, store_key, backend, cached=True)
+            else:
+                result = self.generator.generate(
+                    prompt=job.prompt,
+                    width=job.width,
+                    height=job.height,
+                    steps=job.steps,
+                    progress=lambda fraction: job.update(progress=fraction)
+                )
+                if isinstance(result, dict) and "error" not in result:
+                    # After a failover the image comes from another backend: store it under that one's key
+                    backend = result.get("backend", backend)
+                    store_key = self.store.key(job.prompt, job.width, job.height, job.steps, backend)
+                    result = self._save(job, store_key, backend, result)
+        except Exception as e:
+            logger.error(f"Image job {job.id} crashed: {str(e)}", exc_info=True)
+            result = {"error": str(e)}
+
+        with self.lock:
+            self.in_flight.pop(job.key, None)
+        self._finish(job, result)
+        return job
+
+    def _finish(self, job: ImageJob, result):
+        if isinstance(result, dict) and "error" in result:
+            self.stats["failed"] += 1
+            job.update(status="failed", error=result["error"], finished_at=time.time())
+        else:
+            self.stats["completed"] += 1
+            self.stats["from_store"] += bool(result.get("cached"))
+            job.update(status="done", progress=1.0, result=result, finished_at=time.time())
+
+    def _save(self, job: ImageJob, store_key: str, backend: str, result: dict) -> dict:
+        """Move the image bytes into the store; the result then carries a URL instead"""
+        try:
+            if isinstance(result.get("image"), bytes):
+                data = result["image"]
+            elif result.get("image"):
+                data = base64.b64decode(result["image"])
+            else:
+                # DALL-E hands back a short-lived URL; keep our own copy
+                response = http_client.get(result["image_url"], timeout=60)
+                response.raise_for_status()
+                data = response.content
+            self.store.put(store_key, data)
+        except Exception as e:
+            logger.warning(f"Could not store image for job {job.id}: {str(e)}")
+            if isinstance(result.get("image"), bytes):
+                return {**result, "image": base64.b64encode(result["image"]).decode("ascii")}
+            return result
+        return self._stored_result(job, store_key, result.get("generator", backend), cached=False)
+
+    @staticmethod
+    def _stored_result(job: ImageJob, store_key: str, generator: str, cached: bool) -> dict:
+        return {
+            "status": "success",
+            "image_url": f"/images/{store_key}",
+            "image_key": store_key,
+            "prompt": job.prompt,
+            "generator": generator,
+            "cached": cached
+        }
+
+    def _prune(self):
+        """Forget finished jobs older than the TTL (lock held)"""
+        cutoff = time.time() - self.job_ttl
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished and job.finished_at < cutoff]:
+            del self.jobs[job_id]
+
+    def get(self, job_id: str):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    async def wait(self, job: ImageJob) -> ImageJob:
+        """Await a job from async code without blocking the event loop"""
+        # shield: a disconnecting waiter must not cancel a job others may share
+        return await asyncio.shield(asyncio.wrap_future(job.future))
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {**self.stats, "in_flight": len(self.in_flight), "tracked": len(self.jobs)}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Create global instance
+image_jobs = ImageJobQueue(
+    image_generator,
+    image_store,
+    workers=int(os.getenv("IMAGE_WORKERS", "2")),
+    max_queue=int(os.getenv("IMAGE_MAX_QUEUE", "32")),
+    job_ttl=float(os.getenv("IMAGE_JOB_TTL_SECONDS", "3600"))
+)
@@ -0,0 +1,56 @@
+import os
+import hashlib
+from typing import Optional
+
+from cache import DiskCache
+
+# Leading bytes of the formats our backends return
+_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+]
+
+
+class ImageStore:
+    """
+    Generated images on disk, addressed by what produced them: a hash of
+    prompt, size, steps and backend. Asking for the same image again is a
+    file lookup instead of a generation run, and files are streamed to
+    clients rather than inlined as base64. The directory is capped at
+    `max_bytes`, evicting least recently served images first.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.files = DiskCache(directory, max_bytes)
+
+    @staticmethod
+    def key(prompt: str, width: int, height: int, steps: int, backend: str) -> str:
+        return hashlib.sha256(f"{backend}\x00{width}x{height}\x00{steps}\x00{prompt}".encode()).hexdigest()
+
+    def lookup(self, key: str) -> Optional[str]:
+        return self.files.locate(key)
+
+    def put(self, key: str, data: bytes) -> str:
+        return self.files.set(key, data)
+
+    @staticmethod
+    def media_type(path: str) -> str:
+        with open(path, "rb") as f:
+            head = f.read(12)
+        for signature, media_type in _SIGNATURES:
+            if head.startswith(signature):
+                return media_type
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return "image/webp"
+        return "application/octet-stream"
+
+    def get_stats(self) -> dict:
+        return self.files.get_stats()
+
+
+# Create global instance
+image_store = ImageStore(
+    os.getenv("IMAGE_STORE_DIR", "generated_images"),
+    int(os.getenv("IMAGE_STORE_MB", "1024")) * 1024 * 1024
+)
@@ -0,0 +1,243 @@
+import os
+import time
+import asyncio
+import threading
+import logging
+from collections import deque
+
+from model_manager import model_manager
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class GenerationJob:
+    """A single queued generation whose tokens are streamed back to one asyncio client"""
+
+    def __init__(self, model_id: str, prompt: str, context: list, params: dict,
+                 loop: asyncio.AbstractEventLoop):
+        self.model_id = model_id
+        self.prompt = prompt
+        self.context = context
+        self.params = params
+        self.cancelled = threading.Event()
+        self.stream = None
+        self.state = None
+        self.sampler = None
+        self.generated = 0
+        self._loop = loop
+        self._tokens = asyncio.Queue()
+
+    def emit(self, item):
+        """Hand a token (or _DONE / an exception) from the scheduler thread to the event loop"""
+        self._loop.call_soon_threadsafe(self._tokens.put_nowait, item)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    async def atokens(self):
+        """Yield tokens as the scheduler produces them"""
+        finished = False
+        try:
+            while True:
+                item = await self._tokens.get()
+                if item is _DONE or isinstance(item, Exception):
+                    finished = True
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Consumer went away early (client disconnected) - free the slot
+            if not finished:
+                self.cancel()
+
+
+class ModelScheduler:
+    """
+    Per-model scheduler.
+    All decoding for a model happens on one worker thread that owns the shared
+    Llama object. Up to `max_active` sequences are decoded round-robin, each
+    getting a `slice_seconds` turn before the next one runs. The KV state of
+    a sequence is saved when it is parked and restored when it resumes, so
+    interleaved streams never see each other's context.
+
+    A swap copies the whole context state (KV cache plus logits, hundreds of
+    MB for the Qwen models), so interleaving only pays off with long slices
+    and is off by default: with max_active=1 each sequence runs to completion
+    in arrival order and nothing is ever swapped.
+    """
+
+    def __init__(self, model_manager, model_id: str, max_active: int, slice_seconds: float):
+        self.model_manager = model_manager
+        self.model_id = model_id
+        self.max_active = max(1, max_active)
+        self.slice_seconds = slice_seconds
+        self.pending = deque()
+        self.active = []
+        self.resident = None
+        self.llm = None
+        self.cond = threading.Condition()
+        self.stats = {
+            "submitted": 0, "completed": 0, "failed": 0, "tokens": 0, "swaps": 0,
+            "cancelled": 0, "cancelled_queued": 0, "cancelled_tokens_avoided": 0
+        }
+        self.worker = threading.Thread(target=self._run, name=f"scheduler-{model_id}", daemon=True)
+        self.worker.start()
+
+    def submit(self, job: GenerationJob):
+        with self.cond:
+            self.pending.append(job)
+            self.stats["submitted"] += 1
+            self.cond.notify()
+
+    def _drop_cancelled_pending(self):
+        """Jobs cancelled while still queued never take a slot (lock held)"""
+        for job in [job for job in self.pending if job.cancelled.is_set()]:
+            self.pending.remove(job)
+            self.stats["cancelled"] += 1
+            self.stats["cancelled_queued"] += 1
+            self.stats["cancelled_tokens_avoided"] += (job.params.get("max_tokens") or 512)
+            job.emit(_DONE)
+
+    def _admit(self):
+        with self.cond:
+            self._drop_cancelled_pending()
+            while not self.active and not self.pending:
+                self.cond.wait()
+                self._drop_cancelled_pending()
+            if not self.active:
+                # Keep the model resident while it has sequences in flight
+                self.model_manager.residency.retain(self.model_id)
+            while self.pending and len(self.active) < self.max_active:
+                self.active.append(self.pending.popleft())
+
+    def _run(self):
+        while True:
+            self._admit()
+            for job in list(self.active):
+                self._step(job)
+
+    def _swap_in(self, llm, job: GenerationJob):
+        """Make `job` the sequence whose state lives in the model context"""
+        if self.resident is job:
+            return
+        if self.resident is not None and self.resident in self.active:
+            self.resident.state = llm.save_state()
+            self.resident.sampler = getattr(llm, "_sampler", None)
+        if job.state is not None:
+            llm.load_state(job.state)
+            if job.sampler is not None:
+                llm._sampler = job.sampler
+            job.state = None
+            job.sampler = None
+            with self.cond:
+                self.stats["swaps"] += 1
+        self.resident = job
+
+    def _finish(self, job: GenerationJob, outcome: str, item=_DONE):
+        with self.cond:
+            self.active.remove(job)
+            self.stats[outcome] += 1
+            idle = not self.active
+        if self.resident is job:
+            self.resident = None
+        if job.stream is not None:
+            # Closing the generator unwinds llama.cpp's completion loop as well
+            job.stream.close()
+            job.stream = None
+        job.state = None
+        job.sampler = None
+        job.emit(item)
+        if idle:
+            self.llm = None
+            self.model_manager.residency.release(self.model_id)
+
+    def _step(self, job: GenerationJob):
+        if job.cancelled.is_set():
+            remaining = (job.params.get("max_tokens") or 512) - job.generated
+            with self.cond:
+                self.stats["cancelled_tokens_avoided"] += max(0, remaining)
+            self._finish(job, "cancelled")
+            return
+
+        try:
+            # Retained while sequences are active, so one lookup serves them all
+            if self.llm is None:
+                self.llm = self.model_manager.load_model(self.model_id)
+            self._swap_in(self.llm, job)
+            if job.stream is None:
+                job.stream = self.model_manager.generate_stream(
+                    self.model_id, job.prompt, job.context, **job.params
+                )
+            turn_ends = time.monotonic() + self.slice_seconds
+            while time.monotonic() < turn_ends:
+                if job.cancelled.is_set():
+                    break
+                token = next(job.stream)
+                job.generated += 1
+                with self.cond:
+                    self.stats["tokens"] += 1
+                job.emit(token)
+        except StopIteration:
+            self._finish(job, "completed")
+        except Exception as e:
+            logger.error(f"Generation failed for {self.model_id}: {str(e)}", exc_info=True)
+            self._finish(job, "failed", e)
+
+    def get_stats(self) -> dict:
+        with self.cond:
+            return {
+                **self.stats,
+                "active": len(self.active),
+                "queued": len(self.pending),
+                "max_active": self.max_active,
+                "slice_seconds": self.slice_seconds
+            }
+
+
+class InferenceScheduler:
+    """Routes generation requests to one ModelScheduler per model"""
+
+    def __init__(self, model_manager):
+        self.model_manager = model_manager
+        self.max_active = int(os.getenv("SCHEDULER_MAX_ACTIVE", "1"))
+        self.slice_seconds = float(os.getenv("SCHEDULER_SLICE_SECONDS", "2.0"))
+        self.schedulers = {}
+        self.lock = threading.Lock()
+
+    def _get_scheduler(self, model_id: str) -> ModelScheduler:
+        with self.lock:
+            if model_id not in self.schedulers:
+                if model_id not in self.model_manager.model_configs:
+                    raise ValueError(f"Model {model_id} not configured")
+                # With a draft model every swap would also copy the n_ctx x n_vocab logits buffer
+                max_active = 1 if self.model_manager.draft_for(model_id) else self.max_active
+                self.schedulers[model_id] = ModelScheduler(
+                    self.model_manager, model_id, max_active, self.slice_seconds
+                )
+            return self.schedulers[model_id]
+
+    def submit(self, model_id: str, prompt: str, context: list,
+               loop: asyncio.AbstractEventLoop, **kwargs) -> GenerationJob:
+        """Queue a generation; consume it with `job.atokens()` on `loop`"""
+        job = GenerationJob(model_id, prompt, context, kwargs, loop)
+        self._get_scheduler(model_id).submit(job)
+        return job
+
+    def get_cancellation_stats(self) -> dict:
+        totals = {"cancelled": 0, "cancelled_queued": 0, "cancelled_tokens_avoided": 0}
+        for stats in self.get_stats().values():
+            for key in totals:
+                totals[key] += stats[key]
+        return totals
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            schedulers = dict(self.schedulers)
+        return {model_id: s.get_stats() for model_id, s in schedulers.items()}
+
+# Create global instance
+inference_scheduler = InferenceScheduler(model_manager)
@@ -1,5 +1,5 @@
-from fastapi import FastAPI, UploadFile, File, Body, HTTPException, Request
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, UploadFile, File, Body, HTTPException, Request, Depends
+from fastapi.responses import StreamingResponse, JSONResponse, FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
@@ -8,13 +8,29 @@ import json
 import sys
 from dotenv import load_dotenv
 from typing import Optional, List
+from contextlib import asynccontextmanager
+import threading
+import asyncio
 import logging
 
+import services
+
 from model_manager import model_manager
-from ocr_engine import ocr_engine
+from inference_scheduler import inference_scheduler
+from ocr_engine import (
+    ocr_engine, read_upload, OCRBusyError, OCRTimeoutError, OCRImageTooLargeError,
+    MAX_UPLOAD_BYTES, MAX_BATCH_UPLOAD_BYTES
+)
 from database import db_manager
 from image_generator import image_generator
+from image_jobs import image_jobs, ImageQueueFullError
+from image_store import image_store
 from tools import tool_executor
+from tool_router import tool_router
+from response_cache import response_cache, TIME_SENSITIVE_TOOLS
+from http_client import http_client
+from conversation import conversation_store
+from retention import retention_engine
 
 # Setup logging
 logging.basicConfig(
@@ -26,7 +42,77 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-app = FastAPI(title="AI Platform API")
+async def run_retention_periodically(interval: float):
+    """Apply message retention every `interval` seconds without blocking the loop"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(retention_engine.run)
+        except Exception as e:
+            logger.error(f"Scheduled cleanup failed: {str(e)}", exc_info=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm services up in the background so the server starts answering immediately
+    threading.Thread(target=services.warm_up_all, name="warm-up", daemon=True).start()
+    retention_interval = float(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+    retention_task = None
+    if retention_interval > 0:
+        retention_task = asyncio.create_task(run_retention_periodically(retention_interval))
+    yield
+    if retention_task:
+        retention_task.cancel()
+    if db_manager.initialized:
+        db_manager.shutdown()
+    if model_manager.initialized:
+        model_manager.cleanup()
+    ocr_engine.shutdown()
+    image_jobs.shutdown()
+    if image_generator.initialized:
+        image_generator.shutdown()
+
+class UploadLimitMiddleware:
+    """
+    Caps request bodies on upload routes before Starlette spools the
+    multipart form: a declared Content-Length over the limit gets 413 without
+    reading anything, and a body that keeps going past it (chunked uploads)
+    is cut off with 413 as soon as it crosses the limit.
+    """
+
+    def __init__(self, app, limits: dict):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+
+        detail = f"Upload exceeds {limit // (1024 * 1024)}MB"
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > limit:
+            return await JSONResponse(status_code=413, content={"detail": detail})(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app = FastAPI(title="AI Platform API", lifespan=lifespan)
+
+# Added before CORS so that its 413s still carry CORS headers
+app.add_middleware(
+    UploadLimitMiddleware,
+    limits={"/upload-image": MAX_UPLOAD_BYTES + 64 * 1024, "/ocr/batch": MAX_BATCH_UPLOAD_BYTES}
+)
 
 # Configure CORS
 app.add_middleware(
@@ -49,20 +135,54 @@ async def root():
         "status": "online",
         "endpoints": {
             "health": "/health",
+            "ready": "/ready",
             "chat": "/chat",
+            "history": "/history/{user_id}",
             "upload": "/upload-image",
-            "cleanup": "/cleanup"
+            "ocr_batch": "/ocr/batch",
+            "image_jobs": "/image-jobs",
+            "cleanup": "/cleanup",
+            "stats": "/stats"
         }
     }
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "version": "1.0.0"}
+    """Liveness: the process is up and serving requests"""
+    return {"status": "healthy", "version": "1.0.0", "ready": services.readiness()["ready"]}
+
+@app.get("/ready")
+async def readiness_check():
+    """Readiness: critical models loaded and services warmed up"""
+    readiness = services.readiness()
+    if not readiness["ready"]:
+        return JSONResponse(status_code=503, content=readiness)
+    return readiness
+
+@app.get("/stats")
+async def stats():
+    """Runtime counters for the inference pipeline"""
+    return {
+        "scheduler": inference_scheduler.get_stats(),
+        "cancellations": inference_scheduler.get_cancellation_stats(),
+        "prompt_cache": model_manager.get_cache_stats(),
+        "speculative": model_manager.get_speculative_stats(),
+        "models": model_manager.get_residency_stats(),
+        "tool_cache": tool_executor.get_cache_stats(),
+        "http": http_client.get_stats(),
+        "message_writes": db_manager.get_write_stats(),
+        "ocr": ocr_engine.get_stats(),
+        "image_jobs": image_jobs.get_stats(),
+        "image_store": image_store.get_stats(),
+        "response_cache": response_cache.get_stats()
+    }
 
 class ChatRequest(BaseModel):
     message: str
     model: str = "tinyllama"
     user_id: str = "default_user"
+    # Server-side history is per conversation; without an id only the sent context is used
+    conversation_id: Optional[str] = None
     context: Optional[List[dict]] = None
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.95
@@ -70,82 +190,49 @@ class ChatRequest(BaseModel):
     repeat_penalty: Optional[float] = 1.1
     use_tools: Optional[bool] = True
     tools: Optional[List[str]] = None
+    cache: Optional[bool] = None  # None: cache only temperature 0 requests
+
+async def cancel_on_disconnect(http_request: Request, job, interval: float = 0.5):
+    """Cancel a generation as soon as its client goes away"""
+    while not job.cancelled.is_set():
+        if await http_request.is_disconnected():
+            logger.info(f"Client disconnected, cancelling generation after {job.generated} tokens")
+            job.cancel()
+            return
+        await asyncio.sleep(interval)
 
 @app.post("/chat")
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, http_request: Request):
     try:
         logger.info(f"Chat request: model={request.model}, user={request.user_id}, use_tools={request.use_tools}")
         
-        def stream_response():
+        def remember(answer: str):
+            """Queue both turns for a batched background insert so [DONE] never waits on the database"""
+            conversation_store.record(request.user_id, request.conversation_id, "user", request.message, request.model)
+            conversation_store.record(request.user_id, request.conversation_id, "assistant", answer, request.model)
+
+        async def stream_response():
             full_response = ""
             tools_used = []
             
             try:
                 # Detect if tools should be used based on message content
-                tool_keywords = {
-                    "web_search": ["search", "look up", "find", "google", "what is", "who is", "latest", "how"],
-                    "weather": ["weather", "temperature", "forecast", "rain", "sunny", "climate", "cloudy", "hot", "cold", "degree"],
-                    "news": ["news", "headlines", "today", "current events", "breaking", "updates"],
-                    "stock_price": ["stock", "price", "$", "market", "trading", "share"],
-                    "crypto_price": ["bitcoin", "ethereum", "crypto", "digital", "btc", "eth", "coin", "price"],
-                    "time": ["time", "what time", "current time", "timezone", "tokyo", "london", "newyork", "paris", "sydney", "moscow"],
-                    "calculator": ["calculate", "math", "solve", "equation", "plus", "minus", "multiply", "divide", "number"],
-                    "currency_convert": ["convert", "exchange", "currency", "dollar", "euro", "pound", "yen"],
-                    "wikipedia": ["wiki", "wikipedia", "learn about", "tell me about", "definition"]
-                }
-                
-                message_lower = request.message.lower()
-                available_tools = []
+                actual_message = request.message
+                extra_context = []
                 
                 if request.use_tools:
-                    for tool, keywords in tool_keywords.items():
-                        if any(keyword in message_lower for keyword in keywords):
-                            if request.tools is None or tool in request.tools:
-                                available_tools.append(tool)
+                    # One regex pass picks the tools and their arguments (max 3 per query)
+                    calls = tool_router.route(request.message, allowed=request.tools, limit=3)
                     
-                    # Execute detected tools
+                    # Execute detected tools concurrently under one shared deadline
                     tool_results = {}
-                    for tool in available_tools[:3]:  # Limit to 3 tools per query
-                        try:
-                            logger.info(f"Executing tool: {tool}")
-                            
-                            # Parse tool parameters from message
-                            if tool == "web_search":
-                                result = tool_executor.execute_tool(tool, query=request.message)
-                            elif tool == "weather":
-                                # Extract city name (simple approach)
-                                parts = request.message.split("in ")
-                                city = parts[-1].split("?")[0].strip() if len(parts) > 1 else "London"
-                                result = tool_executor.execute_tool(tool, city=city)
-                            elif tool == "crypto_price":
-                                # Extract crypto name
-                                for crypto in ["bitcoin", "ethereum", "cardano", "solana", "btc", "eth", "ada", "sol"]:
-                                    if crypto in message_lower:
-                                        result = tool_executor.execute_tool(tool, crypto=crypto)
-                                        break
-                                else:
-                                    result = tool_executor.execute_tool(tool, crypto="bitcoin")
-                            elif tool == "time":
-                                # Extract timezone name if available
-                                timezone = "UTC"
-                                for tz in ["tokyo", "tokyo time", "jst", "est", "pst", "cet"]:
-                                    if tz in message_lower:
-                                        tz_map = {"tokyo": "JST", "tokyo time": "JST", "jst": "JST", "est": "EST", "pst": "PST", "cet": "CET"}
-                                        timezone = tz_map.get(tz, "UTC")
-                                        break
-                                result = tool_executor.execute_tool(tool, timezone=timezone)
-                            elif tool == "calculator":
-                                # Extract expression (simple)
-                                result = tool_executor.execute_tool(tool, expression=request.message)
-                            else:
-                                result = tool_executor.execute_tool(tool)
-                            
-                            if result.get("status") == "success":
-                                tool_results[tool] = result
-                                tools_used.append(tool)
-                                logger.info(f"Tool {tool} executed successfully")
-                        except Exception as e:
-                            logger.error(f"Tool {tool} execution failed: {str(e)}")
+                    for tool, result in (await tool_executor.execute_many_async(calls)).items():
+                        if result.get("status") == "success":
+                            tool_results[tool] = result
+                            tools_used.append(tool)
+                            logger.info(f"Tool {tool} executed successfully")
+                        else:
+                            logger.error(f"Tool {tool} execution failed: {result.get('message')}")
                     
                     # Add tool results to context
                     if tool_results:
@@ -172,8 +259,7 @@ async def chat_endpoint(request: ChatRequest):
                         
                         # Enhanced message with tool data
                         enhanced_message = f"{request.message}{tool_context}\n\nPlease provide an answer based on this real-time information."
-                        request.context = request.context or []
-                        request.context.append({
+                        extra_context.append({
                             "role": "system",
                             "content": f"You have access to real-time data. Use this information to provide accurate, current answers.{tool_context}"
                         })
@@ -187,6 +273,11 @@ async def chat_endpoint(request: ChatRequest):
                     if tools_used:
                         yield f"data: {json.dumps({'tools_used': tools_used})}\n\n"
                 
+                # Client may have given up while tools were running
+                if await http_request.is_disconnected():
+                    logger.info("Client disconnected before generation, skipping")
+                    return
+                
                 # Generate response with model
                 params = {
                     "temperature": request.temperature,
@@ -195,15 +286,58 @@ async def chat_endpoint(request: ChatRequest):
                     "repeat_penalty": request.repeat_penalty
                 }
                 
-                for token in model_manager.generate_stream(request.model, actual_message, request.context, **params):
-                    full_response += token
-                    yield f"data: {json.dumps({'token': token})}\n\n"
+                # Use server-side history of this conversation unless the client sent its own, trimmed to fit n_ctx
+                history = request.context
+                if history is None and request.conversation_id:
+                    history = await asyncio.to_thread(
+                        conversation_store.recent, request.user_id, request.conversation_id
+                    )
+                count_tokens = lambda text: model_manager.count_tokens(request.model, text)
+                budget = model_manager.context_budget(request.model, actual_message, request.max_tokens)
+                budget -= sum(count_tokens(msg["content"]) + 8 for msg in extra_context)
+                context = conversation_store.build_context(history, budget, count_tokens) + extra_context
+                
+                # Deterministic requests may be answered from earlier identical ones
+                cache_key = None
+                if response_cache.eligible(request.temperature, request.cache):
+                    if TIME_SENSITIVE_TOOLS.intersection(tools_used):
+                        response_cache.bypass()
+                    else:
+                        model_file = model_manager.model_configs.get(request.model, {}).get("file", "")
+                        cache_key = response_cache.key(request.model, model_file, actual_message, context, params)
+                        cached_tokens = await response_cache.lookup(cache_key)
+                        if cached_tokens is not None:
+                            for token in cached_tokens:
+                                yield f"data: {json.dumps({'token': token})}\n\n"
+                            logger.info(f"Response served from cache: {len(cached_tokens)} tokens")
+                            remember("".join(cached_tokens))
+                            yield "data: [DONE]\n\n"
+                            return
+                
+                # Decoding runs on the model's scheduler thread; tokens arrive via an asyncio queue
+                job = inference_scheduler.submit(
+                    request.model, actual_message, context,
+                    loop=asyncio.get_running_loop(), **params
+                )
+                watcher = asyncio.create_task(cancel_on_disconnect(http_request, job))
+                tokens = []
+                try:
+                    async for token in job.atokens():
+                        tokens.append(token)
+                        full_response += token
+                        yield f"data: {json.dumps({'token': token})}\n\n"
+                finally:
+                    watcher.cancel()
+                if job.cancelled.is_set():
+                    return
+                
+                # Only complete generations are cached, never ones cut short by a disconnect
+                if cache_key:
+                    await response_cache.store(cache_key, tokens)
                 
                 logger.info(f"Response generated: {len(full_response)} tokens, tools used: {tools_used}")
                 
-                # Store in database
-                db_manager.store_message(request.user_id, request.message, "user", request.model)
-                db_manager.store_message(request.user_id, full_response, "assistant", request.model)
+                remember(full_response)
                 
                 yield "data: [DONE]\n\n"
             except Exception as e:
@@ -215,23 +349,100 @@ async def chat_endpoint(request: ChatRequest):
         logger.error(f"Chat endpoint error: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/history/{user_id}")
+async def get_history(user_id: str, limit: int = 50, before: Optional[str] = None,
+                      conversation_id: Optional[str] = None):
+    """Page through a user's stored messages (optionally one conversation), newest page first"""
+    try:
+        messages = await asyncio.to_thread(db_manager.get_history, user_id, min(limit, 200), before, conversation_id)
+        return {
+            "messages": messages,
+            "next_before": messages[0]["created_at"] if messages else None
+        }
+    except Exception as e:
+        logger.error(f"History fetch error: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+def ocr_options(
+    quality: str = "accurate",
+    binarize: bool = False,
+    deskew: bool = False,
+    denoise: bool = False,
+    detect_text: bool = True,
+    psm: str = "auto"
+) -> dict:
+    """Per-request OCR preprocessing; quality is accurate, fast or auto (fast under load)"""
+    return {
+        "quality": quality, "binarize": binarize, "deskew": deskew,
+        "denoise": denoise, "detect_text": detect_text, "psm": psm
+    }
+
 @app.post("/upload-image")
-async def upload_image(file: UploadFile = File(...)):
+async def upload_image(file: UploadFile = File(...), options: dict = Depends(ocr_options)):
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
     
     try:
-        content = await file.read()
-        extracted_text = ocr_engine.extract_text(content)
+        content = await read_upload(file)
+        extracted_text = await ocr_engine.extract_text_async(content, options)
         return {"text": extracted_text}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except OCRImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except OCRBusyError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except OCRTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/ocr/batch")
+async def ocr_batch(files: List[UploadFile] = File(...), stream: bool = False,
+                    options: dict = Depends(ocr_options)):
+    """OCR several images and/or multi-page TIFFs; pages run in parallel on the OCR pool"""
+    try:
+        contents = []
+        for file in files:
+            if not file.content_type.startswith("image/"):
+                raise HTTPException(status_code=400, detail=f"{file.filename} is not an image")
+            contents.append(await read_upload(file))
+        names = [file.filename for file in files]
+
+        if not stream:
+            pages = await ocr_engine.extract_pages_async(contents, options)
+            return {"pages": [{"filename": names[page["image"]], **page} for page in pages]}
+
+        # Planning and slot reservation happen here, so busy/too-large still map to HTTP errors
+        pages = ocr_engine.iter_pages(contents, options)
+        first = await anext(pages, None)
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except OCRImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except OCRBusyError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except OCRTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def stream_pages():
+        page = first
+        while page is not None:
+            yield f"data: {json.dumps({'filename': names[page['image']], **page})}\n\n"
+            page = await anext(pages, None)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream_pages(), media_type="text/event-stream")
+
 @app.get("/cleanup")
 async def cleanup_chats():
     try:
-        db_manager.cleanup_old_messages()
-        return {"message": "Cleanup successful"}
+        result = await asyncio.to_thread(retention_engine.run)
+        return {"message": "Cleanup successful", **result}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -243,20 +454,74 @@ class ImageGenerationRequest(BaseModel):
 
 @app.post("/generate-image")
 async def generate_image(request: ImageGenerationRequest):
-    """Generate an image from text prompt"""
+    """Generate an image from text prompt (waits for the queued job)"""
     try:
         logger.info(f"Image generation request: {request.prompt}")
-        result = image_generator.generate(
-            prompt=request.prompt,
-            width=request.width,
-            height=request.height,
-            steps=request.steps
-        )
-        return result
+        job, _ = image_jobs.submit(request.prompt, request.width, request.height, request.steps)
+        await image_jobs.wait(job)
+        if job.status == "failed":
+            return {"error": job.error}
+        return job.result
+    except ImageQueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
     except Exception as e:
         logger.error(f"Image generation error: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/image-jobs")
+async def submit_image_job(request: ImageGenerationRequest):
+    """Queue an image generation and return its job id immediately"""
+    try:
+        job, deduplicated = image_jobs.submit(request.prompt, request.width, request.height, request.steps)
+        return {"job_id": job.id, "status": job.status, "deduplicated": deduplicated}
+    except ImageQueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+@app.get("/image-jobs/{job_id}")
+async def get_image_job(job_id: str):
+    """Poll an image job"""
+    job = image_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired image job")
+    return job.to_dict()
+
+@app.get("/image-jobs/{job_id}/events")
+async def image_job_events(job_id: str):
+    """Stream job snapshots (status, progress, result) as SSE until it finishes"""
+    job = image_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired image job")
+
+    async def stream_events():
+        events = job.subscribe(asyncio.get_running_loop())
+        try:
+            while True:
+                snapshot = await events.get()
+                yield f"data: {json.dumps(snapshot)}\n\n"
+                if snapshot["status"] in ("done", "failed"):
+                    break
+            yield "data: [DONE]\n\n"
+        finally:
+            job.unsubscribe(events)
+
+    return StreamingResponse(stream_events(), media_type="text/event-stream")
+
+@app.api_route("/images/{key}", methods=["GET", "HEAD"])
+async def get_image(key: str, request: Request):
+    """Serve a generated image from the store (ETag + Range aware)"""
+    if len(key) != 64 or any(c not in "0123456789abcdef" for c in key):
+        raise HTTPException(status_code=404, detail="Image not found")
+    path = image_store.lookup(key)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    # The key identifies the inputs that produced the image, so it is a stable validator
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=86400"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=image_store.media_type(path), headers=headers)
+
 @app.get("/image-status")
 async def image_generation_status():
     """Get current image generation backend status"""
@@ -0,0 +1,255 @@
+import os
+import re
+import json
+import hashlib
+import threading
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+
+from http_client import http_client
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, per-process dedupe still applies
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+
+
+class ChecksumError(Exception):
+    pass
+
+
+class ModelDownloader:
+    """
+    Parallel, resumable, checksum-verified downloads of model files.
+    Files are fetched as fixed-size byte-range segments on several
+    connections into `<file>.part`; finished segments are recorded in
+    `<file>.part.json` so an interrupted download resumes where it stopped.
+    The result is checked against the SHA256 from the model config, else the
+    one the server publishes (Hugging Face LFS files carry it in
+    X-Linked-Etag), and renamed into place. The manifest remembers verified
+    files so they are not re-hashed on every start.
+    """
+
+    def __init__(self, models_dir: str, session=None):
+        self.models_dir = models_dir
+        self.session = session or http_client
+        self.workers = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+        self.segment_size = int(os.getenv("DOWNLOAD_SEGMENT_MB", "32")) * MB
+        self.timeout = int(os.getenv("DOWNLOAD_TIMEOUT", "60"))
+        self.manifest_path = os.getenv("MODEL_MANIFEST", os.path.join(models_dir, "manifest.json"))
+        self.manifest = self._load_json(self.manifest_path) or {}
+        self.lock = threading.Lock()
+        self.in_progress = {}
+        self.prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-prefetch")
+
+    @staticmethod
+    def _load_json(path: str):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_json(path: str, data):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, path)
+
+    def ensure(self, url: str, filename: str, sha256: str = None) -> str:
+        """Return the local path of `filename`, downloading it if missing or invalid"""
+        with self.lock:
+            future = self.in_progress.get(filename)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.in_progress[filename] = future
+        if not owner:
+            return future.result()
+
+        try:
+            path = self._ensure_locked(url, filename, sha256)
+            future.set_result(path)
+            return path
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.in_progress.pop(filename, None)
+
+    def _ensure_locked(self, url: str, filename: str, sha256: str = None) -> str:
+        """Serialize on a lock file so several uvicorn workers share one download"""
+        if fcntl is None:
+            return self._ensure(url, filename, sha256)
+        with open(os.path.join(self.models_dir, f".{filename}.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another worker may have finished the file while we waited
+            with self.lock:
+                self.manifest.update(self._load_json(self.manifest_path) or {})
+            return self._ensure(url, filename, sha256)
+
+    def prefetch(self, entries) -> list:
+        """Download (url, filename, sha256) entries one after another in the background"""
+        return [self.prefetcher.submit(self.ensure, *entry) for entry in entries]
+
+    def _ensure(self, url: str, filename: str, sha256: str = None) -> str:
+        target = os.path.join(self.models_dir, filename)
+        entry = self.manifest.get(filename, {})
+        expected = sha256 or entry.get("sha256")
+
+        if os.path.exists(target):
+            size = os.path.getsize(target)
+            if entry.get("size") == size and (not sha256 or entry.get("sha256") == sha256):
+                logger.info(f"✓ {filename} found in cache ({size / MB:.1f} MB)")
+                return target
+            # No manifest record (e.g. fetched before verification existed) - check it once
+            total, _, published = self._probe(url)
+            expected = expected or published
+            if expected:
+                digest = self._sha256(target)
+                valid = digest == expected
+            else:
+                digest = None
+                valid = total == size if total else size > 100 * MB
+            if valid:
+                self._record(filename, target, digest)
+                return target
+            logger.warning(f"⚠ {filename} failed verification, re-downloading")
+            os.remove(target)
+
+        self._download(url, target, expected)
+        return target
+
+    @staticmethod
+    def _published_sha256(response):
+        """SHA256 the server vouches for; on Hugging Face it is on the redirect, not the CDN response"""
+        for hop in [*response.history, response]:
+            etag = hop.headers.get("X-Linked-Etag", "")
+            etag = etag.removeprefix("W/").strip('"').lower()
+            if SHA256_HEX.match(etag):
+                return etag
+        return None
+
+    def _probe(self, url: str):
+        """Return (total size, supports ranges, published sha256) using a one-byte range request"""
+        try:
+            response = self.session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=self.timeout)
+            response.close()
+        except requests.exceptions.RequestException:
+            return None, False, None
+        published = self._published_sha256(response)
+        if response.status_code == 206 and "/" in response.headers.get("Content-Range", ""):
+            total = response.headers["Content-Range"].rsplit("/", 1)[1]
+            if total.isdigit():
+                return int(total), True, published
+        if response.ok and response.headers.get("Content-Length"):
+            return int(response.headers["Content-Length"]), False, published
+        return None, False, published
+
+    def _download(self, url: str, target: str, expected: str = None):
+        part = f"{target}.part"
+        state_path = f"{part}.json"
+        total, ranges, published = self._probe(url)
+        expected = expected or published
+        if not expected:
+            logger.warning(f"⚠ No published SHA256 for {os.path.basename(target)}; it cannot be verified")
+        logger.info(f"Downloading {os.path.basename(target)} "
+                    f"({total / MB:.1f} MB)" if total else f"Downloading {os.path.basename(target)}")
+
+        if total and ranges:
+            state = self._load_json(state_path)
+            fresh = {"url": url, "size": total, "segment_size": self.segment_size}
+            if not state or any(state.get(k) != v for k, v in fresh.items()) or not os.path.exists(part):
+                state = {**fresh, "done": []}
+                with open(part, "wb") as f:
+                    f.truncate(total)
+                self._write_json(state_path, state)
+            elif state["done"]:
+                logger.info(f"Resuming with {len(state['done'])} segments already on disk")
+            self._download_segments(url, part, state, state_path)
+        else:
+            self._download_single(url, part)
+
+        digest = self._sha256(part)
+        if expected and digest != expected:
+            os.remove(part)
+            if os.path.exists(state_path):
+                os.remove(state_path)
+            raise ChecksumError(f"SHA256 mismatch for {os.path.basename(target)}: expected {expected}, got {digest}")
+
+        os.replace(part, target)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        self._record(os.path.basename(target), target, digest)
+        logger.info(f"✓ {os.path.basename(target)} downloaded" + (" and verified" if expected else ""))
+
+    def _download_segments(self, url: str, part: str, state: dict, state_path: str):
+        total = state["size"]
+        done = set(state["done"])
+        segments = [
+            (start, min(start + self.segment_size, total) - 1)
+            for start in range(0, total, self.segment_size)
+            if start not in done
+        ]
+        progress_lock = threading.Lock()
+        next_report = [0]
+
+        def fetch(segment):
+            start, end = segment
+            response = self.session.get(
+                url, headers={"Range": f"bytes={start}-{end}"}, stream=True, timeout=self.timeout
+            )
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise IOError(f"Server ignored range request for bytes {start}-{end}")
+            with open(part, "r+b") as f:
+                f.seek(start)
+                written = 0
+                for chunk in response.iter_content(chunk_size=MB):
+                    f.write(chunk)
+                    written += len(chunk)
+            if written != end - start + 1:
+                raise IOError(f"Short read for bytes {start}-{end}: got {written}")
+            with progress_lock:
+                state["done"].append(start)
+                self._write_json(state_path, state)
+                percent = len(state["done"]) * 100 // ((total + self.segment_size - 1) // self.segment_size)
+                if percent >= next_report[0]:
+                    logger.info(f"  {percent}% of {total / MB:.1f} MB")
+                    next_report[0] = percent + 10
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="model-download") as pool:
+            for future in [pool.submit(fetch, segment) for segment in segments]:
+                future.result()
+
+    def _download_single(self, url: str, part: str):
+        """Fallback for servers without range support (cannot resume)"""
+        response = self.session.get(url, stream=True, timeout=self.timeout)
+        response.raise_for_status()
+        with open(part, "wb") as f:
+            for chunk in response.iter_content(chunk_size=MB):
+                f.write(chunk)
+
+    @staticmethod
+    def _sha256(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(4 * MB), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _record(self, filename: str, path: str, digest: str = None):
+        # Hash outside the lock: multi-GB files would stall every other ensure()
+        entry = {"sha256": digest or self._sha256(path), "size": os.path.getsize(path)}
+        with self.lock:
+            self.manifest[filename] = entry
+            self._write_json(self.manifest_path, self.manifest)
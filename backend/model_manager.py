@@ -1,81 +1,249 @@
 import os
-from llama_cpp import Llama
-import requests
+from llama_cpp import Llama, LlamaRAMCache
+from llama_cpp.llama_speculative import LlamaDraftModel
 from typing import Generator
+import numpy as np
 import hashlib
 import json
 
+from model_residency import ModelResidency, detect_ram_budget
+from runtime_profiles import RuntimeProfiles
+from model_downloader import ModelDownloader
+from services import LazyService
+
+class PromptCache(LlamaRAMCache):
+    """
+    LRU cache of llama.cpp KV states keyed by token prefix.
+    A follow-up turn shares its whole transcript with the state saved at the
+    end of the previous turn, so only the new tokens have to be evaluated.
+    """
+
+    def __init__(self, capacity_bytes: int):
+        super().__init__(capacity_bytes=capacity_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    def __setitem__(self, key, state):
+        # save_state copies the whole n_batch x n_vocab logits buffer (~300 MB for Qwen).
+        # Without logits_all only the last row is meaningful, and generate() re-evaluates
+        # the last prompt token anyway, so one row is all a cached state needs
+        if state.scores is not None and len(state.scores) > 1:
+            state.scores = state.scores[-1:].copy()
+        # LlamaRAMCache would evict every entry trying to make room for one that can never fit
+        if state.llama_state_size + (state.scores.nbytes if state.scores is not None else 0) > self.capacity_bytes:
+            self.skipped += 1
+            return
+        super().__setitem__(key, state)
+
+    def __getitem__(self, key):
+        try:
+            state = super().__getitem__(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return state
+
+    @property
+    def cache_size(self) -> int:
+        # llama_state_size covers only the KV state; each LlamaState also carries its own logits copy
+        return sum(
+            state.llama_state_size + (state.scores.nbytes if state.scores is not None else 0)
+            for state in self.cache_state.values()
+        )
+
+    def get_stats(self) -> dict:
+        return {
+            "entries": len(self.cache_state),
+            "size_mb": round(self.cache_size / 1024 / 1024, 1),
+            "capacity_mb": round(self.capacity_bytes / 1024 / 1024, 1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped": self.skipped
+        }
+
+class SpeculativeDraft(LlamaDraftModel):
+    """
+    Draft model for llama.cpp speculative decoding.
+    A small model with the target's tokenizer greedily proposes the next few
+    tokens; the target evaluates them in one batch and keeps the prefix it
+    agrees with. How much of a proposal survived shows up in the sequence
+    passed to the next call, which drives the acceptance counters and grows
+    or shrinks the proposal length.
+    """
+
+    def __init__(self, draft_id: str, llm: Llama, max_tokens: int = 8):
+        self.draft_id = draft_id
+        self.llm = llm
+        self.max_tokens = max_tokens
+        self.num_pred_tokens = max_tokens
+        self.pending = None  # (input_ids, proposal) of the last call
+        self.calls = 0
+        self.proposed = 0
+        self.accepted = 0
+
+    def _settle(self, input_ids: np.ndarray):
+        """Score the previous proposal against the sequence the target kept"""
+        if self.pending is None:
+            return
+        previous, proposal = self.pending
+        self.pending = None
+        length = len(previous)
+        # A different prompt means the last generation ended; its final proposal goes unscored
+        if len(input_ids) <= length or not np.array_equal(input_ids[:length], previous):
+            return
+        kept = input_ids[length:length + len(proposal)]
+        matches = kept == proposal[:len(kept)]
+        accepted = len(kept) if matches.all() else int(np.argmin(matches))
+        self.proposed += len(proposal)
+        self.accepted += accepted
+        if accepted == len(proposal):
+            self.num_pred_tokens = min(self.max_tokens, self.num_pred_tokens + 2)
+        else:
+            self.num_pred_tokens = max(1, self.num_pred_tokens - 1)
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs) -> np.ndarray:
+        self._settle(input_ids)
+        proposal = []
+        eos = self.llm.token_eos()
+        # reset=True reuses the draft's KV cache for the prefix it has already seen
+        for token in self.llm.generate(input_ids.tolist(), temp=0.0, reset=True):
+            if token == eos:
+                break
+            proposal.append(token)
+            if len(proposal) >= self.num_pred_tokens:
+                break
+        proposal = np.array(proposal, dtype=np.intc)
+        self.pending = (input_ids.copy(), proposal)
+        self.calls += 1
+        return proposal
+
+    def get_stats(self) -> dict:
+        return {
+            "draft_model": self.draft_id,
+            "calls": self.calls,
+            "proposed": self.proposed,
+            "accepted": self.accepted,
+            "acceptance_rate": round(self.accepted / self.proposed, 3) if self.proposed else 0.0,
+            # Target tokens produced per batched verification pass
+            "tokens_per_pass": round((self.accepted + self.calls) / self.calls, 2) if self.calls else 0.0,
+            "num_pred_tokens": self.num_pred_tokens
+        }
+
 class ModelManager:
     def __init__(self):
-        self.models = {}
+        self.prompt_caches = {}
+        self.drafts = {}
+        # Speculative decoding for models with a configured "draft_model" (same tokenizer).
+        # Off by default: llama.cpp then keeps logits for every position (n_ctx x n_vocab
+        # float32), so paired models get a capped context and no prompt cache.
+        # benchmark_speculative.py measures whether it pays off on a given machine.
+        self.speculative = os.getenv("SPECULATIVE_DECODING", "0").lower() in ("1", "true", "yes")
+        self.draft_tokens = int(os.getenv("SPECULATIVE_DRAFT_TOKENS", "8"))
+        self.speculative_max_ctx = int(os.getenv("SPECULATIVE_MAX_CTX", "2048"))
+        # Per-model budget for cached prompt states (0 disables the cache). A state is the
+        # KV cache of the tokens seen so far, so 512 MB holds several full-context Qwen turns
+        self.prompt_cache_bytes = int(os.getenv("PROMPT_CACHE_MB", "512")) * 1024 * 1024
         self.model_configs = {
             "fast-chat": {
                 "repo": "Qwen/Qwen2.5-0.5B-Instruct-GGUF",
                 "file": "qwen2.5-0.5b-instruct-q4_k_m.gguf",
                 "url": "https://huggingface.co/Qwen/Qwen2.5-0.5B-Instruct-GGUF/resolve/main/qwen2.5-0.5b-instruct-q4_k_m.gguf",
-                "format": "chatml"
+                "format": "chatml",
+                "runtime": {"n_ctx": 4096, "n_batch": 512}
             },
             "tinyllama": {
                 "repo": "TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF",
                 "file": "tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf",
                 "url": "https://huggingface.co/TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF/resolve/main/tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf",
-                "format": "tinyllama"
+                "format": "tinyllama",
+                "runtime": {"n_ctx": 2048, "n_batch": 512}
             },
             "coder": {
                 "repo": "Qwen/Qwen2.5-Coder-1.5B-Instruct-GGUF",
                 "file": "qwen2.5-coder-1.5b-instruct-q4_k_m.gguf",
                 "url": "https://huggingface.co/Qwen/Qwen2.5-Coder-1.5B-Instruct-GGUF/resolve/main/qwen2.5-coder-1.5b-instruct-q4_k_m.gguf",
-                "format": "chatml"
+                "format": "chatml",
+                "runtime": {"n_ctx": 4096, "n_batch": 512},
+                "draft_model": "fast-chat",
+                "n_vocab": 151936
             },
             "deepseek-coder": {
                 "repo": "TheBloke/dolphin-2.1-mistral-7B-GGUF",
                 "file": "dolphin-2.1-mistral-7b.Q4_K_M.gguf",
                 "url": "https://huggingface.co/TheBloke/dolphin-2.1-mistral-7B-GGUF/resolve/main/dolphin-2.1-mistral-7b.Q4_K_M.gguf",
                 "format": "chatml",
+                "runtime": {"n_ctx": 4096, "n_batch": 256},
                 "size_gb": 2.0
             },
             "phi-3.5": {
                 "repo": "TheBloke/dolphin-2.0-mistral-7B-GGUF",
                 "file": "dolphin-2.0-mistral-7b.Q4_K_M.gguf",
                 "url": "https://huggingface.co/TheBloke/dolphin-2.0-mistral-7B-GGUF/resolve/main/dolphin-2.0-mistral-7b.Q4_K_M.gguf",
-                "format": "chatml"
+                "format": "chatml",
+                "runtime": {"n_ctx": 4096, "n_batch": 256}
             },
             "mistral": {
                 "repo": "TheBloke/Mistral-7B-Instruct-v0.1-GGUF",
                 "file": "mistral-7b-instruct-v0.1.Q4_K_M.gguf",
                 "url": "https://huggingface.co/TheBloke/Mistral-7B-Instruct-v0.1-GGUF/resolve/main/mistral-7b-instruct-v0.1.Q4_K_M.gguf",
-                "format": "chatml"
+                "format": "chatml",
+                "runtime": {"n_ctx": 4096, "n_batch": 256}
             },
             "neural-chat": {
                 "repo": "TheBloke/neural-chat-7B-v3-2-GGUF",
                 "file": "neural-chat-7b-v3-2.Q4_K_M.gguf",
                 "url": "https://huggingface.co/TheBloke/neural-chat-7B-v3-2-GGUF/resolve/main/neural-chat-7b-v3-2.Q4_K_M.gguf",
-                "format": "chatml"
+                "format": "chatml",
+                "runtime": {"n_ctx": 4096, "n_batch": 256}
             },
             "llama-2": {
                 "repo": "TheBloke/Llama-2-7B-Chat-GGUF",
                 "file": "llama-2-7b-chat.Q4_K_M.gguf",
                 "url": "https://huggingface.co/TheBloke/Llama-2-7B-Chat-GGUF/resolve/main/llama-2-7b-chat.Q4_K_M.gguf",
-                "format": "chatml"
+                "format": "chatml",
+                "runtime": {"n_ctx": 4096, "n_batch": 256}
             },
             "zephyr": {
                 "repo": "TheBloke/neural-chat-7B-v3-3-GGUF",
                 "file": "neural-chat-7b-v3-3.Q4_K_M.gguf",
                 "url": "https://huggingface.co/TheBloke/neural-chat-7B-v3-3-GGUF/resolve/main/neural-chat-7b-v3-3.Q4_K_M.gguf",
-                "format": "chatml"
+                "format": "chatml",
+                "runtime": {"n_ctx": 4096, "n_batch": 256}
             },
             "opencoder": {
                 "repo": "TheBloke/Llama-2-13B-chat-GGUF",
                 "file": "llama-2-13b-chat.Q4_K_M.gguf",
                 "url": "https://huggingface.co/TheBloke/Llama-2-13B-chat-GGUF/resolve/main/llama-2-13b-chat.Q4_K_M.gguf",
                 "format": "chatml",
+                "runtime": {"n_ctx": 2048, "n_batch": 256, "kv_cache_type": "q8_0"},
                 "size_gb": 3.5
             }
         }
+        self.system_text = (
+            "You are a helpful AI assistant. "
+            "For math, use LaTeX with $ $ for display and \\( \\) for inline."
+        )
         self.models_dir = os.path.join(os.getcwd(), "models")
         os.makedirs(self.models_dir, exist_ok=True)
         self.critical_models = ["fast-chat"]
+        self.downloader = ModelDownloader(self.models_dir)
+        self.runtime = RuntimeProfiles(self.models_dir)
+        self.residency = ModelResidency(
+            loader=self._create_llama,
+            size_of=self._resident_bytes,
+            budget_bytes=detect_ram_budget(),
+            pinned=self.critical_models,
+            on_evict=self._forget
+        )
+        self.models = self.residency.models
+
+    def warmup(self):
+        """Download and load the critical models (run in the background at startup)"""
         self.auto_download_critical()
+        for model_id in self.critical_models:
+            self.residency.prefetch(model_id).result()
 
     def auto_download_critical(self):
         """Download only critical lightweight models at startup"""
@@ -83,63 +251,108 @@ class ModelManager:
         for model_id in self.critical_models:
             try:
                 path = self.download_model(model_id)
+                self.residency.prefetch(model_id)
                 print(f"✓ {model_id} ready")
             except Exception as e:
                 print(f"✗ Failed to ensure {model_id}: {e}")
+        if os.getenv("PREFETCH_MODELS", "0").lower() in ("1", "true", "yes"):
+            self.prefetch_all_models()
 
     def download_model(self, model_id: str):
         config = self.model_configs.get(model_id)
         if not config:
             raise ValueError(f"Model {model_id} not configured")
-        
-        target_path = os.path.join(self.models_dir, config["file"])
-        
-        # Check if model already exists and is valid
-        if os.path.exists(target_path):
-            file_size = os.path.getsize(target_path)
-            # Check if file size is reasonable (at least 100MB for GGUF models)
-            if file_size > 100000000:
-                print(f"✓ {model_id} found in cache ({file_size / 1024 / 1024:.1f} MB)")
-                return target_path
-            else:
-                print(f"⚠ Incomplete file detected, re-downloading...")
-                os.remove(target_path)
-
-        print(f"Downloading {model_id}...")
+        return self.downloader.ensure(config["url"], config["file"], config.get("sha256"))
+
+    def prefetch_all_models(self):
+        """Download every configured model in the background, one at a time"""
+        return self.downloader.prefetch(
+            (config["url"], config["file"], config.get("sha256"))
+            for config in self.model_configs.values()
+        )
+
+    def load_model(self, model_id: str):
+        """Return a resident model, loading it (and evicting others) if needed"""
+        return self.residency.get(model_id)
+
+    def prefetch_model(self, model_id: str):
+        """Load a model in the background without blocking the caller"""
+        return self.residency.prefetch(model_id)
+
+    def runtime_profile(self, model_id: str) -> dict:
+        """Resolved llama.cpp runtime settings (n_ctx, threads, batch, ...) for a model"""
+        profile = self.runtime.resolve(model_id, self.model_configs[model_id])
+        if self.draft_for(model_id):
+            profile = {**profile, "n_ctx": min(profile["n_ctx"], self.speculative_max_ctx)}
+        return profile
+
+    def draft_for(self, model_id: str):
+        """Draft model id paired with `model_id`, or None when it decodes alone"""
+        return self.model_configs[model_id].get("draft_model") if self.speculative else None
+
+    def _logits_bytes(self, model_id: str) -> int:
+        """The n_ctx x n_vocab float32 logits buffer llama.cpp keeps while drafting"""
+        return self.runtime_profile(model_id)["n_ctx"] * self.model_configs[model_id]["n_vocab"] * 4
+
+    def _resident_bytes(self, model_id: str) -> int:
+        size = os.path.getsize(self.download_model(model_id))
+        draft_id = self.draft_for(model_id)
+        if draft_id:
+            # The draft is a dedicated copy that lives and dies with its target
+            size += os.path.getsize(self.download_model(draft_id)) + self._logits_bytes(model_id)
+        return size
+
+    def _forget(self, model_id: str):
+        self.prompt_caches.pop(model_id, None)
+        self.drafts.pop(model_id, None)
+
+    def _create_draft(self, model_id: str, profile: dict):
+        draft_id = self.draft_for(model_id)
+        if not draft_id:
+            return None
         try:
-            response = requests.get(config["url"], stream=True, timeout=120)
-            response.raise_for_status()
-            total_size = int(response.headers.get('content-length', 0))
-            downloaded = 0
-            
-            with open(target_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192*128):  # 1MB chunks
-                    if chunk:
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        if total_size:
-                            progress = (downloaded / total_size) * 100
-                            print(f"  {progress:.1f}% ({downloaded / 1024 / 1024:.1f} MB / {total_size / 1024 / 1024:.1f} MB)")
-            
-            print(f"✓ {model_id} downloaded successfully")
-            return target_path
+            # Its own instance: the resident draft model's KV state belongs to its own requests.
+            # It reads the whole target sequence, so it needs the target's context size.
+            draft_profile = {**self.runtime_profile(draft_id), "n_ctx": profile["n_ctx"]}
+            llm = Llama(
+                model_path=self.download_model(draft_id),
+                verbose=False,
+                **self.runtime.llama_kwargs(draft_profile)
+            )
         except Exception as e:
-            if os.path.exists(target_path):
-                os.remove(target_path)
-            raise e
+            print(f"✗ Draft model {draft_id} unavailable, {model_id} decodes without it: {e}")
+            return None
+        self.drafts[model_id] = SpeculativeDraft(draft_id, llm, self.draft_tokens)
+        return self.drafts[model_id]
 
-    def load_model(self, model_id: str):
-        if model_id in self.models:
-            return self.models[model_id]
-        
+    def _create_llama(self, model_id: str):
         path = self.download_model(model_id)
-        self.models[model_id] = Llama(
+        # Calibrate threads once, on the small critical model when available
+        try:
+            tune_path = self.download_model(self.critical_models[0])
+        except Exception:
+            tune_path = path
+        self.runtime.ensure_tuned(tune_path)
+
+        profile = self.runtime_profile(model_id)
+        draft = self._create_draft(model_id, profile)
+        print(f"Loading {model_id} (n_ctx={profile['n_ctx']}, n_threads={profile['n_threads']}, "
+              f"n_batch={profile['n_batch']}, kv={profile['kv_cache_type']}, "
+              f"draft={draft.draft_id if draft else None})")
+        llm = Llama(
             model_path=path,
-            n_ctx=1024,
-            n_threads=2,
-            verbose=False
+            verbose=False,
+            draft_model=draft,
+            # Verifying a draft samples at every drafted position, and llama-cpp-python only
+            # sizes its scores buffer for that when asked explicitly
+            logits_all=draft is not None,
+            **self.runtime.llama_kwargs(profile)
         )
-        return self.models[model_id]
+        # PromptCache keeps one logits row per state, which is only valid without logits_all
+        if self.prompt_cache_bytes > 0 and draft is None:
+            self.prompt_caches[model_id] = PromptCache(self.prompt_cache_bytes)
+            llm.set_cache(self.prompt_caches[model_id])
+        return llm
 
     def format_prompt(self, model_id: str, system: str, history: list, prompt: str):
         fmt = self.model_configs[model_id]["format"]
@@ -147,7 +360,7 @@ class ModelManager:
         if fmt == "chatml":
             full = f"<|im_start|>system\n{system}<|im_end|>\n"
             for msg in history:
-                role = "user" if msg["role"] == "user" else "assistant"
+                role = msg["role"] if msg["role"] in ("user", "system") else "assistant"
                 full += f"<|im_start|>{role}\n{msg['content']}<|im_end|>\n"
             full += f"<|im_start|>user\n{prompt}<|im_end|>\n<|im_start|>assistant\n"
             return full, ["<|im_end|>", "###", "<|im_start|>", "</s>"]
@@ -155,22 +368,31 @@ class ModelManager:
         elif fmt == "tinyllama":
             full = f"<|system|>\n{system}</s>\n"
             for msg in history:
-                role = "user" if msg["role"] == "user" else "assistant"
+                role = msg["role"] if msg["role"] in ("user", "system") else "assistant"
                 full += f"<|{role}|>\n{msg['content']}</s>\n"
             full += f"<|user|>\n{prompt}</s>\n<|assistant|>\n"
             return full, ["</s>", "<|user|>", "<|assistant|>"]
 
         return prompt, ["</s>"]
 
+    def count_tokens(self, model_id: str, text: str) -> int:
+        """Exact count with the model's tokenizer when it is loaded, else ~4 chars/token"""
+        llm = self.models.get(model_id)
+        if llm is not None:
+            return len(llm.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+        return len(text) // 4 + 1
+
+    def context_budget(self, model_id: str, prompt: str, max_tokens: int = None) -> int:
+        """Tokens left for conversation history after system text, prompt and the answer"""
+        n_ctx = self.runtime_profile(model_id)["n_ctx"]
+        answer = min(max_tokens or 512, n_ctx // 2)
+        reserved = self.count_tokens(model_id, self.system_text) + self.count_tokens(model_id, prompt) + 32
+        return n_ctx - answer - reserved
+
     def generate_stream(self, model_id: str, prompt: str, context: list = None, **kwargs) -> Generator[str, None, None]:
         llm = self.load_model(model_id)
         
-        system_text = (
-            "You are a helpful AI assistant. "
-            "For math, use LaTeX with $ $ for display and \\( \\) for inline."
-        )
-        
-        full_prompt, stop_tokens = self.format_prompt(model_id, system_text, context or [], prompt)
+        full_prompt, stop_tokens = self.format_prompt(model_id, self.system_text, context or [], prompt)
         
         params = {
             "max_tokens": kwargs.get("max_tokens", 512),
@@ -184,11 +406,25 @@ class ModelManager:
             token = output["choices"][0]["text"]
             yield token
 
+    def get_cache_stats(self) -> dict:
+        """Prompt-prefix cache usage per loaded model"""
+        return {model_id: cache.get_stats() for model_id, cache in self.prompt_caches.items()}
+
+    def get_speculative_stats(self) -> dict:
+        """Draft acceptance per loaded target model"""
+        return {
+            "enabled": self.speculative,
+            "models": {model_id: draft.get_stats() for model_id, draft in self.drafts.items()}
+        }
+
+    def get_residency_stats(self) -> dict:
+        """Loaded models, memory budget and load/evict counters"""
+        return {**self.residency.get_stats(), "runtime": self.runtime.get_stats()}
+
     def cleanup(self):
         """Cleanup resources"""
-        for model in self.models.values():
-            if hasattr(model, 'close'):
-                model.close()
-        self.models.clear()
+        self.residency.clear()
+        self.prompt_caches.clear()
+        self.drafts.clear()
 # Create global instance
-model_manager = ModelManager()
\ No newline at end of file
+model_manager = LazyService("model_manager", ModelManager, warmup="warmup")
\ No newline at end of file
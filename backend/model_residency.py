@@ -0,0 +1,158 @@
+import os
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+
+def detect_ram_budget() -> int:
+    """Default budget: MODEL_RAM_BUDGET_GB, else 75% of physical memory, else 8 GB"""
+    configured = os.getenv("MODEL_RAM_BUDGET_GB")
+    if configured:
+        return int(float(configured) * 1024 ** 3)
+    try:
+        return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 0.75)
+    except (ValueError, OSError, AttributeError):
+        return 8 * 1024 ** 3
+
+
+class ModelResidency:
+    """
+    Keeps loaded models inside a RAM budget.
+    Models are sized by their file on disk, kept in LRU order and evicted
+    oldest-first when a new one does not fit. Pinned models and models with
+    active generations are never evicted. Loads run on a background executor
+    and concurrent requests for a model that is still loading share that load.
+    A load reserves its size before it starts, so parallel loads cannot claim
+    the same headroom.
+    """
+
+    def __init__(self, loader: Callable, size_of: Callable, budget_bytes: int,
+                 pinned: Iterable[str] = (), on_evict: Callable = None):
+        self.loader = loader
+        self.size_of = size_of
+        self.on_evict = on_evict
+        self.budget_bytes = budget_bytes
+        self.pinned = set(pinned)
+        self.models = OrderedDict()
+        self.sizes = {}
+        self.reserved = {}  # sizes of loads in progress, counted before they finish
+        self.in_use = {}
+        self.loading = {}
+        self.lock = threading.Lock()
+        # Signalled whenever a load finishes, so loads waiting for room can retry
+        self.load_done = threading.Condition(self.lock)
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("MODEL_LOADER_WORKERS", "2")),
+            thread_name_prefix="model-loader"
+        )
+        self.stats = {"loads": 0, "load_failures": 0, "evictions": 0, "hits": 0}
+
+    def get(self, model_id: str, timeout: float = None):
+        """Return a loaded model, waiting for its (single) load if needed"""
+        with self.lock:
+            if model_id in self.models:
+                self.models.move_to_end(model_id)
+                self.stats["hits"] += 1
+                return self.models[model_id]
+        return self.prefetch(model_id).result(timeout)
+
+    def prefetch(self, model_id: str) -> Future:
+        """Start loading a model in the background (no-op if loaded or loading)"""
+        with self.lock:
+            if model_id in self.models:
+                future = Future()
+                future.set_result(self.models[model_id])
+                return future
+            if model_id not in self.loading:
+                self.loading[model_id] = self.executor.submit(self._load, model_id)
+            return self.loading[model_id]
+
+    def retain(self, model_id: str):
+        with self.lock:
+            self.in_use[model_id] = self.in_use.get(model_id, 0) + 1
+
+    def release(self, model_id: str):
+        with self.lock:
+            count = self.in_use.get(model_id, 0) - 1
+            if count > 0:
+                self.in_use[model_id] = count
+            else:
+                self.in_use.pop(model_id, None)
+
+    def _load(self, model_id: str):
+        try:
+            size = self.size_of(model_id)
+            with self.lock:
+                self._make_room(size, model_id)
+                # Concurrent loads must see this one's size, or both could claim the same headroom
+                self.reserved[model_id] = size
+            llm = self.loader(model_id)
+            with self.lock:
+                self.models[model_id] = llm
+                self.sizes[model_id] = self.reserved.pop(model_id)
+                self.stats["loads"] += 1
+            logger.info(f"Loaded {model_id} ({size / 1024 ** 3:.2f} GB, {self._used() / 1024 ** 3:.2f} GB resident)")
+            return llm
+        except Exception:
+            with self.lock:
+                self.stats["load_failures"] += 1
+            raise
+        finally:
+            with self.lock:
+                self.reserved.pop(model_id, None)
+                self.loading.pop(model_id, None)
+                self.load_done.notify_all()
+
+    def _used(self) -> int:
+        return sum(self.sizes.values()) + sum(self.reserved.values())
+
+    def _make_room(self, size: int, model_id: str):
+        """Evict least-recently-used models until `size` more bytes fit (lock held)"""
+        while self._used() + size > self.budget_bytes:
+            victim = next(
+                (m for m in self.models if m not in self.pinned and not self.in_use.get(m)),
+                None
+            )
+            if victim is None and any(m != model_id for m in self.reserved):
+                # Room is held by loads still in flight; once they land they can be evicted
+                self.load_done.wait()
+                continue
+            if victim is None:
+                logger.warning(
+                    f"Loading {model_id} exceeds the model RAM budget "
+                    f"({(self._used() + size) / 1024 ** 3:.2f} / {self.budget_bytes / 1024 ** 3:.2f} GB); "
+                    "nothing left to evict"
+                )
+                return
+            self._evict(victim)
+
+    def _evict(self, model_id: str):
+        llm = self.models.pop(model_id)
+        self.sizes.pop(model_id, None)
+        self.stats["evictions"] += 1
+        if hasattr(llm, "close"):
+            llm.close()
+        if self.on_evict:
+            self.on_evict(model_id)
+        logger.info(f"Evicted {model_id} from memory")
+
+    def clear(self):
+        with self.lock:
+            for model_id in list(self.models):
+                self._evict(model_id)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                **self.stats,
+                "resident": list(self.models),
+                "loading": list(self.loading),
+                "pinned": sorted(self.pinned),
+                "used_gb": round(self._used() / 1024 ** 3, 2),
+                "reserved_gb": round(sum(self.reserved.values()) / 1024 ** 3, 2),
+                "budget_gb": round(self.budget_bytes / 1024 ** 3, 2)
+            }
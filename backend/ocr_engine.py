@@ -2,29 +2,561 @@ import pytesseract
 from PIL import Image
 import io
 import os
+import json
+import time
+import hashlib
+import warnings
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import AsyncIterator, List, Optional, Tuple
+
+from cache import TTLCache, DiskCache
+from ocr_preprocess import preprocess
+
+# Everything that changes the OCR output for the same bytes goes into the cache key.
+# quality/binarize/deskew/denoise/detect_text/psm can be overridden per request.
+DEFAULT_OPTIONS = {
+    "max_side": 2000,
+    "mode": "L",
+    "draft": True,
+    "quality": "accurate",
+    "binarize": False,
+    "deskew": False,
+    "denoise": False,
+    "detect_text": True,
+    "psm": "auto"
+}
+QUALITY_MAX_SIDE = {"accurate": 2000, "fast": int(os.getenv("OCR_FAST_MAX_SIDE", "1000"))}
+
+# Upload limits: request body (before parsing), each file, decoded size from the header
+MAX_UPLOAD_BYTES = int(float(os.getenv("OCR_MAX_UPLOAD_MB", "20")) * 1024 * 1024)
+MAX_BATCH_UPLOAD_BYTES = int(float(os.getenv("OCR_MAX_BATCH_UPLOAD_MB", "100")) * 1024 * 1024)
+MAX_IMAGE_PIXELS = int(os.getenv("OCR_MAX_PIXELS", "80000000"))
+
+# Tall pages (long screenshots) are OCRed as overlapping horizontal strips
+TILE_HEIGHT = int(os.getenv("OCR_TILE_HEIGHT", "2000"))
+TILE_OVERLAP = int(os.getenv("OCR_TILE_OVERLAP", "200"))
+MAX_BATCH_JOBS = int(os.getenv("OCR_MAX_BATCH_JOBS", "64"))
+
+
+class OCRBusyError(Exception):
+    """All OCR workers and queue slots are taken"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"OCR queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class OCRTimeoutError(Exception):
+    pass
+
+
+class OCRImageTooLargeError(Exception):
+    """Upload exceeds the byte limit or its header declares too many pixels"""
+
+
+def _configure_pil():
+    # PIL warns past this and raises past 2x; plan_pages enforces 1x
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+async def read_upload(upload, max_bytes: int = MAX_UPLOAD_BYTES) -> bytes:
+    """
+    Per-file limit for an already received UploadFile, read in a single copy.
+    The request body itself is capped before parsing by UploadLimitMiddleware.
+    """
+    if getattr(upload, "size", None) and upload.size > max_bytes:
+        raise OCRImageTooLargeError(f"Upload exceeds {max_bytes // (1024 * 1024)}MB")
+    content = await upload.read(max_bytes + 1)
+    if len(content) > max_bytes:
+        raise OCRImageTooLargeError(f"Upload exceeds {max_bytes // (1024 * 1024)}MB")
+    return content
+
+
+def tile_boxes(width: int, height: int) -> List[Optional[tuple]]:
+    """Crop boxes covering a page top to bottom; [None] when it needs no tiling"""
+    tile_height = max(TILE_HEIGHT, width)
+    if height <= tile_height * 1.5:
+        return [None]
+    boxes = []
+    top = 0
+    while True:
+        bottom = min(top + tile_height, height)
+        boxes.append((0, top, width, bottom))
+        if bottom >= height:
+            return boxes
+        top = bottom - TILE_OVERLAP
+
+
+def plan_pages(image_content: bytes) -> List[List[Tuple[int, Optional[tuple]]]]:
+    """
+    (frame, box) jobs for every page of an image, read from headers only.
+    Multi-page TIFFs give one page per frame. Decompression bombs are
+    rejected here, before any pixels are decoded.
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+            with Image.open(io.BytesIO(image_content)) as image:
+                frames = image.n_frames if image.format == "TIFF" else 1
+                if frames > MAX_BATCH_JOBS:
+                    raise OCRImageTooLargeError(f"Document has {frames} pages, limit is {MAX_BATCH_JOBS}")
+                pages = []
+                for frame in range(frames):
+                    image.seek(frame)
+                    width, height = image.size
+                    if width * height > MAX_IMAGE_PIXELS:
+                        raise OCRImageTooLargeError(
+                            f"Image is {width}x{height}, limit is {MAX_IMAGE_PIXELS // 1_000_000}MP"
+                        )
+                    pages.append([(frame, box) for box in tile_boxes(width, height)])
+                return pages
+    except Image.DecompressionBombError as e:
+        raise OCRImageTooLargeError(str(e))
+
+
+def stitch_tiles(texts: List[str], max_overlap_lines: int = 12) -> str:
+    """
+    Join tile texts top to bottom, dropping the lines both neighbours read
+    from the overlap. A line cut by a tile edge may show up as one garbled
+    line at the seam, so the match may skip one line on either side.
+    """
+    def norm(line):
+        return " ".join(line.split())
+
+    lines = []
+    for text in texts:
+        tile = [line for line in text.splitlines() if line.strip()]
+        best = None
+        for skip_prev in (0, 1):
+            for skip_next in (0, 1):
+                prev = lines[:len(lines) - skip_prev] if skip_prev else lines
+                limit = min(len(prev), len(tile) - skip_next, max_overlap_lines)
+                for k in range(limit, 0, -1):
+                    if [norm(l) for l in prev[-k:]] == [norm(l) for l in tile[skip_next:skip_next + k]]:
+                        if best is None or k > best[0]:
+                            best = (k, skip_prev, skip_next)
+                        break
+        if best:
+            k, skip_prev, skip_next = best
+            del lines[len(lines) - skip_prev:]
+            tile = tile[skip_next + k:]
+        lines.extend(tile)
+    return "\n".join(lines)
+
+
+def _configure_tesseract():
+    # On Render, tesseract is usually in /usr/bin/tesseract
+    # On Windows, we use the path provided by the user
+    if os.name == 'nt':
+        pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+
+
+def _worker_init():
+    _configure_tesseract()
+    _configure_pil()
+
+
+def _open_page(image_content: bytes, frame: int, options: dict, tiled: bool) -> Image.Image:
+    image = Image.open(io.BytesIO(image_content))
+    if frame:
+        image.seek(frame)
+    # JPEG: let the decoder downscale by 1/2..1/8 and emit grayscale directly,
+    # so a 50MP photo never exists as a full-resolution bitmap
+    if options["draft"]:
+        max_side = options["max_side"]
+        # Tiled pages only need the width reduced; strip height is bounded by the crop
+        image.draft(options["mode"], (max_side, 1) if tiled else (max_side, max_side))
+    return image
+
+
+def _ocr_image(image: Image.Image, timeout: float, options: dict) -> Optional[str]:
+    max_side = options["max_side"]
+    # Basic preprocessing: Resize if too large
+    if image.width > max_side or image.height > max_side:
+        image.thumbnail((max_side, max_side))
+
+    # Grayscale, then the optional NumPy steps (denoise, deskew, binarize) and PSM choice
+    image, psm = preprocess(image.convert(options["mode"]), options)
+    if image is None:
+        return None
+
+    # timeout makes pytesseract kill the tesseract subprocess
+    text = pytesseract.image_to_string(image, config=f"--psm {psm}", timeout=timeout)
+    return text.strip()
+
+
+def run_ocr(image_content: bytes, timeout: float = 0, frame: int = 0,
+            options: dict = DEFAULT_OPTIONS) -> Optional[str]:
+    """
+    Decode, preprocess and OCR one page (runs inside a pool worker).
+    Returns None when the text check decides there is nothing to read.
+    """
+    return _ocr_image(_open_page(image_content, frame, options, tiled=False), timeout, options)
+
+
+def run_ocr_tile(tile: tuple, timeout: float = 0, options: dict = DEFAULT_OPTIONS) -> Optional[str]:
+    """OCR one (mode, size, pixels) strip cut by crop_tiles (runs inside a pool worker)"""
+    mode, size, pixels = tile
+    return _ocr_image(Image.frombytes(mode, size, pixels), timeout, options)
+
+
+def crop_tiles(image_content: bytes, frame: int, boxes: List[tuple], options: dict) -> List[tuple]:
+    """
+    Decode a tall page once and cut it into raw (mode, size, pixels) strips,
+    so its tiles cost one decode instead of one per worker. Boxes are in
+    full-resolution coordinates, as planned from the header.
+    """
+    with _open_page(image_content, frame, options, tiled=True) as image:
+        scale = image.width / boxes[0][2]
+        page = image.convert(options["mode"])
+    strips = []
+    for box in boxes:
+        if scale != 1:
+            box = tuple(round(edge * scale) for edge in box)
+        strip = page.crop(box)
+        strips.append((strip.mode, strip.size, strip.tobytes()))
+    return strips
+
 
 class OCREngine:
+    """
+    OCR on a bounded process pool.
+    PIL decoding and tesseract run in OCR_WORKERS worker processes, so they
+    neither block the event loop nor contend for the GIL. At most
+    OCR_MAX_QUEUE jobs wait behind the running ones; beyond that callers
+    get OCRBusyError with a Retry-After estimate.
+    """
+
     def __init__(self):
-        # On Render, tesseract is usually in /usr/bin/tesseract
-        # On Windows, we use the path provided by the user
-        if os.name == 'nt':
-            pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+        _configure_tesseract()
+        _configure_pil()
+        self.workers = int(os.getenv("OCR_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+        self.max_queue = int(os.getenv("OCR_MAX_QUEUE", str(self.workers * 4)))
+        self.timeout = float(os.getenv("OCR_TIMEOUT_SECONDS", "30"))
+        self.pool = None
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        # Slots held by jobs submitted to the current pool; written off if it breaks
+        self.pool_jobs = 0
+        self.pool_generation = 0
+        self.slots = None
+        self.slots_loop = None
+        self.avg_seconds = 2.0
+        self.stats = {
+            "completed": 0, "rejected": 0, "timeouts": 0, "errors": 0, "pages": 0, "tiles": 0, "no_text": 0,
+            "pool_restarts": 0
+        }
+        # Results keyed by image hash + preprocessing; optional disk tier survives restarts
+        self.cache = TTLCache(max_entries=int(os.getenv("OCR_CACHE_ENTRIES", "512")))
+        cache_dir = os.getenv("OCR_CACHE_DIR")
+        self.disk_cache = DiskCache(
+            cache_dir, int(os.getenv("OCR_CACHE_DISK_MB", "256")) * 1024 * 1024
+        ) if cache_dir else None
+
+    @staticmethod
+    def image_digest(image_content: bytes) -> str:
+        return hashlib.sha256(image_content).hexdigest()
+
+    @staticmethod
+    def cache_key(image_digest: str, params: dict) -> str:
+        return hashlib.sha256(f"{image_digest}:{json.dumps(params, sort_keys=True)}".encode()).hexdigest()
+
+    async def _cached(self, key: str):
+        text = self.cache.get(key)
+        if text is None and self.disk_cache:
+            data = await asyncio.to_thread(self.disk_cache.get, key)
+            if data is not None:
+                text = data.decode("utf-8")
+                self.cache.set(key, text)
+        return text
+
+    def _store(self, key: str, text: str):
+        self.cache.set(key, text)
+        if self.disk_cache:
+            self.disk_cache.set(key, text.encode("utf-8"))
+
+    def _get_pool(self) -> Tuple[ProcessPoolExecutor, int]:
+        """The live pool and its generation, starting one if needed"""
+        with self.lock:
+            if self.pool is None:
+                # spawn: never fork a process that is running llama.cpp threads
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_worker_init
+                )
+            return self.pool, self.pool_generation
+
+    def _reset_pool(self, generation: int):
+        """
+        Drop a pool whose worker crashed or was OOM-killed; every later submit to
+        it would raise BrokenProcessPool. The next job starts a fresh pool.
+        """
+        with self.lock:
+            if generation != self.pool_generation or self.pool is None:
+                return  # another job already replaced it
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+            self.pool_generation += 1
+            self.in_flight -= self.pool_jobs
+            self.pool_jobs = 0
+            self.stats["pool_restarts"] += 1
+        print("⚠️  OCR worker pool broke, starting a new one")
+
+    def _submit(self, fn, *args):
+        """Submit to the pool, replacing it once if it turns out to be broken"""
+        for attempt in range(2):
+            pool, generation = self._get_pool()
+            try:
+                future = pool.submit(fn, *args)
+            except BrokenProcessPool:
+                self._reset_pool(generation)
+                if attempt:
+                    raise
+                continue
+            with self.lock:
+                if generation == self.pool_generation:
+                    self.pool_jobs += 1
+                else:
+                    self.in_flight -= 1  # its pool was written off while we submitted
+            return future, generation
+
+    def _worker_slots(self, loop: asyncio.AbstractEventLoop) -> asyncio.Semaphore:
+        """
+        One permit per worker process. Jobs wait here rather than in the pool's
+        own queue, so a job's timeout starts when a worker is free to run it.
+        """
+        if self.slots_loop is not loop:
+            self.slots = asyncio.Semaphore(self.workers)
+            self.slots_loop = loop
+        return self.slots
+
+    def _reserve(self, count: int = 1):
+        """Claim `count` pool slots; a batch bigger than the queue still runs when idle"""
+        with self.lock:
+            if self.in_flight and self.in_flight + count > self.workers + self.max_queue:
+                self.stats["rejected"] += 1
+                waves = (self.in_flight - self.workers) // self.workers + 1
+                raise OCRBusyError(retry_after=max(1, round(waves * self.avg_seconds)))
+            self.in_flight += count
+
+    def _release(self, seconds: float = None, generation: int = None):
+        with self.lock:
+            if generation is not None:
+                if generation != self.pool_generation:
+                    return  # written off when its pool was replaced
+                self.pool_jobs -= 1
+            self.in_flight -= 1
+            if seconds is not None:
+                self.avg_seconds = 0.8 * self.avg_seconds + 0.2 * seconds
+
+    def resolve_options(self, overrides: dict = None) -> dict:
+        """
+        Merge per-request overrides into DEFAULT_OPTIONS. quality="auto" picks
+        "fast" while every worker is busy, so latency degrades gracefully.
+        Raises ValueError on unknown options or values.
+        """
+        options = {**DEFAULT_OPTIONS, **(overrides or {})}
+        unknown = set(options) - set(DEFAULT_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown OCR options: {', '.join(sorted(unknown))}")
+        if options["quality"] == "auto":
+            with self.lock:
+                options["quality"] = "fast" if self.in_flight >= self.workers else "accurate"
+        if options["quality"] not in QUALITY_MAX_SIDE:
+            raise ValueError("quality must be one of: accurate, fast, auto")
+        if options["psm"] != "auto":
+            if not str(options["psm"]).isdigit() or not 0 <= int(options["psm"]) <= 13:
+                raise ValueError("psm must be 'auto' or a tesseract page segmentation mode (0-13)")
+            options["psm"] = int(options["psm"])
+        options["max_side"] = QUALITY_MAX_SIDE[options["quality"]]
+        return options
+
+    def _job_key(self, image_digest: str, frame: int, box: Optional[tuple], options: dict) -> str:
+        params = options if not (frame or box) else {**options, "frame": frame, "box": box}
+        return self.cache_key(image_digest, params)
+
+    async def _run_job(self, key: str, fn, *args) -> str:
+        """One pool job (a page or a tile); the caller has reserved its slot"""
+        loop = asyncio.get_running_loop()
+        workers = self._worker_slots(loop)
+        try:
+            await workers.acquire()
+        except asyncio.CancelledError:
+            self._release()
+            raise
+        start = time.monotonic()
+
+        try:
+            future, generation = self._submit(fn, *args)
+        except Exception as e:
+            workers.release()
+            self._release()
+            self.stats["errors"] += 1
+            return f"Error extracting text: {str(e)}"
+
+        def settle(done):
+            # The slot is only free once the worker is: a timed-out job may still be running
+            finished = not done.cancelled() and done.exception() is None
+            self._release(time.monotonic() - start if finished else None, generation)
+            try:
+                loop.call_soon_threadsafe(workers.release)
+            except RuntimeError:
+                pass  # event loop already closed
+
+        future.add_done_callback(settle)
+
+        try:
+            # Submitted jobs are running jobs (see _worker_slots), so queue time is not
+            # counted here; tesseract itself is also killed after `timeout`
+            text = await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout * 2)
+            self.stats["completed"] += 1
+            if text is None:
+                self.stats["no_text"] += 1
+                text = ""
+            await asyncio.to_thread(self._store, key, text)
+            return text
+        except BrokenProcessPool as e:
+            self._reset_pool(generation)
+            self.stats["errors"] += 1
+            return f"Error extracting text: OCR worker crashed ({str(e) or 'pool broken'})"
+        except (asyncio.TimeoutError, RuntimeError) as e:
+            if isinstance(e, RuntimeError) and "timeout" not in str(e).lower():
+                self.stats["errors"] += 1
+                return f"Error extracting text: {str(e)}"
+            self.stats["timeouts"] += 1
+            raise OCRTimeoutError(f"OCR did not finish within {self.timeout:.0f}s")
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"OCR Error: {e}")
+            return f"Error extracting text: {str(e)}"
+
+    async def _start_pages(self, images: List[bytes], options: dict = None) -> List[Tuple[int, int, asyncio.Task]]:
+        """
+        Plan every page of every image, answer what we can from the cache,
+        reserve pool slots for the rest in one go and start them all.
+        Returns (image index, page index, task resolving to the page text).
+        """
+        options = self.resolve_options(options)
+        plans = [plan_pages(content) for content in images]
+        job_count = sum(len(jobs) for pages in plans for jobs in pages)
+        if job_count > MAX_BATCH_JOBS:
+            raise OCRImageTooLargeError(f"Batch needs {job_count} OCR jobs, limit is {MAX_BATCH_JOBS}")
+
+        # One hash per image, off the event loop; page and tile keys are derived from it
+        digests = await asyncio.gather(*(asyncio.to_thread(self.image_digest, content) for content in images))
+
+        resolved = []
+        uncached = 0
+        for digest, pages in zip(digests, plans):
+            for jobs in pages:
+                page = []
+                for frame, box in jobs:
+                    key = self._job_key(digest, frame, box, options)
+                    cached = await self._cached(key)
+                    uncached += cached is None
+                    page.append((key, frame, box, cached))
+                resolved.append(page)
+        if uncached:
+            self._reserve(uncached)
+
+        async def run_page(content, page):
+            if len(page) == 1:
+                key, frame, box, cached = page[0]
+                jobs = [self._run_job(key, run_ocr, content, self.timeout, frame, options) if cached is None
+                        else asyncio.sleep(0, cached)]
+            else:
+                # Tiles: decode the page once here and ship each worker only its strip
+                missing = [box for key, frame, box, cached in page if cached is None]
+                strips = iter(())
+                if missing:
+                    try:
+                        strips = iter(await asyncio.to_thread(crop_tiles, content, page[0][1], missing, options))
+                    except Exception as e:
+                        for _ in missing:
+                            self._release()
+                        self.stats["errors"] += 1
+                        return f"Error extracting text: {str(e)}"
+                jobs = [self._run_job(key, run_ocr_tile, next(strips), self.timeout, options) if cached is None
+                        else asyncio.sleep(0, cached)
+                        for key, frame, box, cached in page]
+            texts = await asyncio.gather(*jobs, return_exceptions=True)
+            for text in texts:
+                if isinstance(text, BaseException):
+                    raise text
+            self.stats["pages"] += 1
+            if len(page) > 1:
+                self.stats["tiles"] += len(page)
+                return stitch_tiles(texts)
+            return texts[0]
+
+        started = []
+        pages = iter(resolved)
+        for image_index, (content, plan) in enumerate(zip(images, plans)):
+            for page_index in range(len(plan)):
+                task = asyncio.ensure_future(run_page(content, next(pages)))
+                started.append((image_index, page_index, task))
+        return started
+
+    async def extract_text_async(self, image_content: bytes, options: dict = None) -> str:
+        """OCR on the process pool; raises OCRBusyError / OCRTimeoutError / OCRImageTooLargeError"""
+        started = await self._start_pages([image_content], options)
+        texts = await asyncio.gather(*(task for _, _, task in started), return_exceptions=True)
+        for text in texts:
+            if isinstance(text, BaseException):
+                raise text
+        return "\n\n".join(texts)
+
+    async def iter_pages(self, images: List[bytes], options: dict = None) -> AsyncIterator[dict]:
+        """
+        OCR every page of every image in parallel, yielding each page as it
+        finishes: {"image", "page", "text"} or {"image", "page", "error"}.
+        Busy/too-large errors are raised before the first page is yielded.
+        """
+        started = await self._start_pages(images, options)
+
+        async def labelled(image_index, page_index, task):
+            try:
+                return {"image": image_index, "page": page_index, "text": await task}
+            except OCRTimeoutError as e:
+                return {"image": image_index, "page": page_index, "error": str(e)}
+
+        for result in asyncio.as_completed([labelled(*entry) for entry in started]):
+            yield await result
+
+    async def extract_pages_async(self, images: List[bytes], options: dict = None) -> List[dict]:
+        """Every page result, ordered by image then page"""
+        results = [result async for result in self.iter_pages(images, options)]
+        return sorted(results, key=lambda result: (result["image"], result["page"]))
 
     def extract_text(self, image_content: bytes) -> str:
+        """In-process OCR (blocking)"""
         try:
-            image = Image.open(io.BytesIO(image_content))
-            
-            # Basic preprocessing: Resize if too large
-            if image.width > 2000 or image.height > 2000:
-                image.thumbnail((2000, 2000))
-            
-            # Convert to grayscale for better OCR
-            image = image.convert('L')
-            
-            text = pytesseract.image_to_string(image)
-            return text.strip()
+            return run_ocr(image_content) or ""
         except Exception as e:
             print(f"OCR Error: {e}")
             return f"Error extracting text: {str(e)}"
 
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                **self.stats,
+                "in_flight": self.in_flight,
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "avg_seconds": round(self.avg_seconds, 2),
+                "cache": self.cache.get_stats(),
+                "disk_cache": self.disk_cache.get_stats() if self.disk_cache else None
+            }
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = None
+
 ocr_engine = OCREngine()
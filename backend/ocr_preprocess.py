@@ -0,0 +1,127 @@
+import numpy as np
+from PIL import Image
+from typing import Optional, Tuple
+
+# Tesseract page segmentation modes we choose between
+PSM_AUTO = 3         # fully automatic page segmentation (tesseract's default)
+PSM_SINGLE_LINE = 7
+PSM_SPARSE = 11      # scattered text: UI screenshots, labels, signs
+
+
+def otsu_threshold(gray: np.ndarray) -> Tuple[int, float]:
+    """Otsu's threshold and its separability (between-class / total variance, 0..1)"""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    total = hist.sum()
+    levels = np.arange(256, dtype=np.float64)
+    weight_bg = np.cumsum(hist)
+    weight_fg = total - weight_bg
+    cum_mean = np.cumsum(hist * levels)
+    global_mean = cum_mean[-1] / total
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_bg = cum_mean / weight_bg
+        mean_fg = (cum_mean[-1] - cum_mean) / weight_fg
+        between = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2 / total ** 2
+    between = np.nan_to_num(between)
+
+    threshold = int(np.argmax(between))
+    variance = (hist * (levels - global_mean) ** 2).sum() / total
+    return threshold, float(between[threshold] / variance) if variance else 0.0
+
+
+def ink_mask(gray: np.ndarray, threshold: int) -> np.ndarray:
+    """True where a pixel is text, whichever of dark-on-light or light-on-dark the page is"""
+    dark = gray <= threshold
+    # Ink is the minority class
+    return dark if dark.mean() <= 0.5 else ~dark
+
+
+def likely_has_text(gray: np.ndarray, separability: float) -> bool:
+    """
+    Cheap check that runs before tesseract. Blank or nearly flat images have
+    no text. Photos have a weakly bimodal histogram and few sharp edges,
+    while glyphs produce dense, high-contrast transitions. The check is
+    conservative: it only says no when both signals agree.
+    """
+    if gray.std() < 6:
+        return False
+    sample = gray[::2, ::2].astype(np.int16)
+    strong_edges = (np.abs(np.diff(sample, axis=1)) > 60).mean()
+    return separability >= 0.8 or strong_edges >= 0.01
+
+
+def median_denoise(gray: np.ndarray) -> np.ndarray:
+    """3x3 median filter (removes salt-and-pepper specks, keeps glyph edges)"""
+    padded = np.pad(gray, 1, mode="edge")
+    windows = np.lib.stride_tricks.sliding_window_view(padded, (3, 3)).reshape(*gray.shape, 9)
+    return np.partition(windows, 4, axis=-1)[..., 4]
+
+
+def estimate_skew(mask: np.ndarray, max_angle: float = 5.0, step: float = 0.25) -> float:
+    """
+    Projection-profile deskew: shear the ink pixel coordinates by each
+    candidate angle and keep the one whose row histogram is sharpest
+    (text lines collapse into narrow, high peaks). Returns degrees.
+    """
+    ys, xs = np.nonzero(mask)
+    if len(ys) < 100:
+        return 0.0
+    if len(ys) > 100_000:
+        pick = np.random.default_rng(0).choice(len(ys), 100_000, replace=False)
+        ys, xs = ys[pick], xs[pick]
+
+    angles = np.arange(-max_angle, max_angle + step / 2, step)
+    # rows[i, j] = row of ink pixel j once the image is rotated by angles[i]
+    rows = np.rint(ys[None, :] - xs[None, :] * np.tan(np.radians(angles))[:, None]).astype(np.int64)
+    rows -= rows.min()
+    height = int(rows.max()) + 1
+    offsets = (np.arange(len(angles)) * height)[:, None]
+    profiles = np.bincount((rows + offsets).ravel(), minlength=len(angles) * height).reshape(len(angles), height)
+    scores = (profiles.astype(np.float64) ** 2).sum(axis=1)
+    return float(angles[int(np.argmax(scores))])
+
+
+def choose_psm(mask: np.ndarray) -> int:
+    """Pick a page segmentation mode from the ink layout"""
+    rows_with_ink = mask.any(axis=1)
+    # Text lines are runs of rows that contain ink
+    line_starts = np.count_nonzero(rows_with_ink[1:] & ~rows_with_ink[:-1]) + int(rows_with_ink[0])
+    height, width = mask.shape
+    if line_starts == 1 and width > height * 3:
+        return PSM_SINGLE_LINE
+    if mask.mean() < 0.01:
+        return PSM_SPARSE
+    return PSM_AUTO
+
+
+def preprocess(image: Image.Image, options: dict) -> Tuple[Optional[Image.Image], int]:
+    """
+    Grayscale image -> (image for tesseract, psm), or (None, 0) when the
+    text check says there is nothing to read. Which steps run is set by
+    `options`: denoise, deskew, binarize, detect_text and psm ("auto" or
+    a tesseract PSM number).
+    """
+    gray = np.asarray(image.convert("L"))
+    threshold, separability = otsu_threshold(gray)
+
+    if options["detect_text"] and not likely_has_text(gray, separability):
+        return None, 0
+
+    if options["denoise"]:
+        gray = median_denoise(gray)
+
+    mask = ink_mask(gray, threshold)
+    if options["deskew"]:
+        angle = estimate_skew(mask)
+        if angle:
+            background = 255 if np.median(gray) > 127 else 0
+            rotated = Image.fromarray(gray).rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=background)
+            gray = np.asarray(rotated)
+            mask = ink_mask(gray, threshold)
+
+    psm = choose_psm(mask) if options["psm"] == "auto" else int(options["psm"])
+
+    if options["binarize"]:
+        # Tesseract wants dark text on a light background
+        return Image.fromarray(np.where(mask, 0, 255).astype(np.uint8)), psm
+    return Image.fromarray(gray), psm
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from typing import List, Optional
+
+from cache import TTLCache, DiskCache
+
+# Tools whose data goes stale within minutes; answers built on them are never cached
+TIME_SENSITIVE_TOOLS = {"weather", "news", "stock_price", "crypto_price", "time", "currency_convert", "web_search"}
+
+
+def normalize_prompt(text: str) -> str:
+    """Case, whitespace and trailing punctuation do not change the question"""
+    return " ".join(text.casefold().split()).rstrip("?!. ")
+
+
+class ResponseCache:
+    """
+    Completed chat responses for deterministic requests.
+    Entries are keyed by model, normalized prompt, a hash of the context
+    and the sampling parameters, and hold the generated token list so a
+    hit can be replayed as the same SSE stream. An LRU memory tier sits in
+    front of an optional size-capped disk tier; both expire after `ttl`.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, disk_dir: str = None, disk_max_bytes: int = 0):
+        self.ttl = ttl
+        self.memory = TTLCache(max_entries=max_entries)
+        self.disk = DiskCache(disk_dir, disk_max_bytes) if disk_dir else None
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "bypassed": 0}
+
+    @staticmethod
+    def eligible(temperature: Optional[float], requested: Optional[bool]) -> bool:
+        """Cache when asked to, or by default for greedy (temperature 0) decoding"""
+        if requested is not None:
+            return requested
+        return temperature == 0
+
+    @staticmethod
+    def key(model_id: str, model_file: str, prompt: str, context: List[dict], params: dict) -> str:
+        payload = json.dumps({
+            "model": model_id,
+            "file": model_file,
+            "prompt": normalize_prompt(prompt),
+            "context": hashlib.sha256(json.dumps(context, sort_keys=True).encode()).hexdigest(),
+            "params": params
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _count(self, stat: str):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def bypass(self):
+        self._count("bypassed")
+
+    def _read_disk(self, key: str) -> Optional[List[str]]:
+        data = self.disk.get(key)
+        if data is None:
+            return None
+        entry = json.loads(data)
+        if entry["expires_at"] < time.time():
+            return None
+        # Promote with whatever lifetime the disk entry has left
+        self.memory.set(key, entry["tokens"], ttl=entry["expires_at"] - time.time())
+        return entry["tokens"]
+
+    async def lookup(self, key: str) -> Optional[List[str]]:
+        tokens = self.memory.get(key)
+        if tokens is None and self.disk:
+            tokens = await asyncio.to_thread(self._read_disk, key)
+        self._count("hits" if tokens is not None else "misses")
+        return tokens
+
+    def _write(self, key: str, tokens: List[str]):
+        self.memory.set(key, tokens, ttl=self.ttl)
+        if self.disk:
+            entry = {"tokens": tokens, "expires_at": time.time() + self.ttl}
+            self.disk.set(key, json.dumps(entry).encode("utf-8"))
+
+    async def store(self, key: str, tokens: List[str]):
+        if not tokens:
+            return
+        await asyncio.to_thread(self._write, key, tokens)
+        self._count("stores")
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+        return {
+            **stats,
+            "memory": self.memory.get_stats(),
+            "disk": self.disk.get_stats() if self.disk else None
+        }
+
+
+# Create global instance
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_ENTRIES", "1000")),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "86400")),
+    disk_dir=os.getenv("RESPONSE_CACHE_DIR", "response_cache") or None,
+    disk_max_bytes=int(os.getenv("RESPONSE_CACHE_DISK_MB", "128")) * 1024 * 1024
+)
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+
+from database import db_manager
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionEngine:
+    """
+    Enforces message retention in bounded batches.
+    Policies resolve most-specific first: a per-user retention overrides a
+    per-model one, which overrides the default. Every batch is a short
+    select-by-age plus delete-by-id, with a pause in between, so the table
+    is never locked for long; a run stops after `max_seconds`.
+
+    RETENTION_POLICIES example:
+        {"default_days": 1, "users": {"vip": 30}, "models": {"coder": 7}}
+    """
+
+    def __init__(self, db, policies: dict = None, batch_size: int = 500,
+                 pause: float = 0.05, max_seconds: float = 60.0):
+        policies = policies or {}
+        self.db = db
+        self.default_days = float(policies.get("default_days", os.getenv("RETENTION_DAYS", "1")))
+        self.user_days = policies.get("users", {})
+        self.model_days = policies.get("models", {})
+        self.batch_size = batch_size
+        self.pause = pause
+        self.max_seconds = max_seconds
+        self.last_run = None
+
+    @staticmethod
+    def _cutoff(days: float, now: datetime) -> str:
+        return (now - timedelta(days=float(days))).isoformat()
+
+    def _rules(self, now: datetime) -> list:
+        """(label, cutoff, delete_expired_batch filters) for every policy"""
+        overridden_users = list(self.user_days)
+        rules = [
+            (f"user:{user_id}", self._cutoff(days, now), {"user_id": user_id})
+            for user_id, days in self.user_days.items()
+        ]
+        rules += [
+            (f"model:{model}", self._cutoff(days, now), {"model_used": model, "exclude_users": overridden_users})
+            for model, days in self.model_days.items()
+        ]
+        rules.append((
+            "default",
+            self._cutoff(self.default_days, now),
+            {"exclude_users": overridden_users, "exclude_models": list(self.model_days)}
+        ))
+        return rules
+
+    def run(self) -> dict:
+        start = time.monotonic()
+        now = datetime.now(timezone.utc)
+        deleted = {}
+        batches = 0
+        complete = True
+
+        for label, cutoff, filters in self._rules(now):
+            deleted[label] = 0
+            while True:
+                if time.monotonic() - start > self.max_seconds:
+                    complete = False
+                    break
+                count = self.db.delete_expired_batch(cutoff, self.batch_size, **filters)
+                deleted[label] += count
+                batches += count > 0
+                if count < self.batch_size:
+                    break
+                time.sleep(self.pause)
+            if not complete:
+                break
+
+        result = {
+            "deleted": sum(deleted.values()),
+            "by_policy": deleted,
+            "batches": batches,
+            "seconds": round(time.monotonic() - start, 3),
+            "complete": complete,
+            "finished_at": datetime.now(timezone.utc).isoformat()
+        }
+        self.last_run = result
+        logger.info(f"Retention run removed {result['deleted']} messages in {result['seconds']}s")
+        return result
+
+
+# Create global instance
+retention_engine = RetentionEngine(
+    db_manager,
+    policies=json.loads(os.getenv("RETENTION_POLICIES", "{}")),
+    batch_size=int(os.getenv("RETENTION_BATCH_SIZE", "500")),
+    max_seconds=float(os.getenv("RETENTION_MAX_SECONDS", "60"))
+)
@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ggml tensor types accepted by llama.cpp for the K/V cache
+KV_CACHE_TYPES = {"f16": 1, "q8_0": 8, "q4_0": 2}
+
+DEFAULT_PROFILE = {
+    "n_ctx": 2048,
+    "n_batch": 512,
+    "n_threads": None,        # None = auto-tuned / detected
+    "n_threads_batch": None,  # None = all available cores
+    "use_mmap": True,
+    "use_mlock": False,
+    "kv_cache_type": "f16"
+}
+
+
+def detect_cores() -> int:
+    """CPU cores this process may actually use (affinity and cgroup quota aware)"""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cores = min(cores, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return max(1, cores)
+
+
+def _parse(value: str, default):
+    if isinstance(default, bool):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    if isinstance(default, int) or default is None:
+        return int(value)
+    return value
+
+
+class RuntimeProfiles:
+    """
+    Resolves llama.cpp runtime settings per model.
+    Precedence (lowest to highest): DEFAULT_PROFILE, the model's "runtime"
+    entry in model_configs, MODEL_PROFILES_FILE (JSON with a "default" key
+    and per-model keys), then LLAMA_<KEY> and LLAMA_<MODEL>_<KEY> env vars.
+    """
+
+    def __init__(self, models_dir: str):
+        self.cores = detect_cores()
+        self.file_overrides = {}
+        profiles_file = os.getenv("MODEL_PROFILES_FILE")
+        if profiles_file and os.path.exists(profiles_file):
+            with open(profiles_file) as f:
+                self.file_overrides = json.load(f)
+        self.autotune_enabled = _parse(os.getenv("LLAMA_AUTOTUNE", "1"), True)
+        self.tuning_path = os.path.join(models_dir, "runtime_tuning.json")
+        self.tuned_threads = self._load_tuning()
+        self.tune_lock = threading.Lock()
+
+    def resolve(self, model_id: str, config: dict) -> dict:
+        profile = dict(DEFAULT_PROFILE)
+        profile.update(config.get("runtime", {}))
+        profile.update(self.file_overrides.get("default", {}))
+        profile.update(self.file_overrides.get(model_id, {}))
+
+        env_id = model_id.upper().replace("-", "_").replace(".", "_")
+        for key, default in DEFAULT_PROFILE.items():
+            for name in (f"LLAMA_{key.upper()}", f"LLAMA_{env_id}_{key.upper()}"):
+                if os.getenv(name):
+                    profile[key] = _parse(os.getenv(name), default)
+
+        if profile["n_threads"] is None:
+            profile["n_threads"] = self.tuned_threads or self.cores
+        if profile["n_threads_batch"] is None:
+            profile["n_threads_batch"] = self.cores
+        if profile["kv_cache_type"] not in KV_CACHE_TYPES:
+            logger.warning(f"Unknown kv_cache_type {profile['kv_cache_type']!r} for {model_id}, using f16")
+            profile["kv_cache_type"] = "f16"
+        return profile
+
+    def llama_kwargs(self, profile: dict) -> dict:
+        """Translate a resolved profile into Llama(...) keyword arguments"""
+        kwargs = {
+            "n_ctx": profile["n_ctx"],
+            "n_batch": profile["n_batch"],
+            "n_threads": profile["n_threads"],
+            "n_threads_batch": profile["n_threads_batch"],
+            "use_mmap": profile["use_mmap"],
+            "use_mlock": profile["use_mlock"]
+        }
+        if profile["kv_cache_type"] != "f16":
+            kv_type = KV_CACHE_TYPES[profile["kv_cache_type"]]
+            kwargs["type_k"] = kv_type
+            kwargs["type_v"] = kv_type
+            # llama.cpp needs flash attention for a quantized V cache
+            kwargs["flash_attn"] = True
+        return kwargs
+
+    def _load_tuning(self):
+        try:
+            with open(self.tuning_path) as f:
+                tuning = json.load(f)
+            if tuning.get("cores") == self.cores:
+                return tuning["n_threads"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def _candidates(self) -> list:
+        candidates = {1, self.cores, max(1, self.cores // 2), max(1, self.cores - 1)}
+        n = 2
+        while n < self.cores:
+            candidates.add(n)
+            n *= 2
+        return sorted(candidates)
+
+    def ensure_tuned(self, model_path: str):
+        """Pick the thread count with the best decode tokens/sec on this host (once)"""
+        if not self.autotune_enabled or self.tuned_threads:
+            return
+        with self.tune_lock:
+            if self.tuned_threads:
+                return
+            from llama_cpp import Llama
+
+            results = {}
+            for n_threads in self._candidates():
+                try:
+                    llm = Llama(model_path=model_path, n_ctx=256, n_threads=n_threads, verbose=False)
+                    llm("Hello", max_tokens=4, temperature=0)  # warm-up
+                    start = time.perf_counter()
+                    output = llm("The history of computing began", max_tokens=32, temperature=0)
+                    elapsed = time.perf_counter() - start
+                    results[n_threads] = output["usage"]["completion_tokens"] / elapsed
+                    llm.close()
+                except Exception as e:
+                    logger.warning(f"Thread calibration with n_threads={n_threads} failed: {str(e)}")
+
+            if not results:
+                return
+            self.tuned_threads = max(results, key=results.get)
+            logger.info(
+                f"Auto-tuned n_threads={self.tuned_threads} on {self.cores} cores "
+                f"({', '.join(f'{n}: {tps:.1f} tok/s' for n, tps in sorted(results.items()))})"
+            )
+            try:
+                with open(self.tuning_path, "w") as f:
+                    json.dump({"cores": self.cores, "n_threads": self.tuned_threads, "tokens_per_sec": results}, f)
+            except OSError:
+                pass
+
+    def get_stats(self) -> dict:
+        return {
+            "cores": self.cores,
+            "tuned_threads": self.tuned_threads,
+            "autotune": self.autotune_enabled
+        }
@@ -0,0 +1,21 @@
+-- Supabase schema for the messages table used by database.py
+-- Run in the Supabase SQL editor. Safe to re-run.
+
+create table if not exists messages (
+    id bigint generated by default as identity primary key,
+    user_id text not null,
+    conversation_id text,
+    role text not null,
+    content text not null,
+    model_used text,
+    created_at timestamptz not null default now()
+);
+
+-- Tables created before conversations were tracked: inserts send conversation_id
+-- and fail until this column exists
+alter table messages add column if not exists conversation_id text;
+
+-- /history pages (user, then conversation) newest first; retention deletes oldest first
+create index if not exists messages_user_created_idx on messages (user_id, created_at);
+create index if not exists messages_conversation_created_idx on messages (user_id, conversation_id, created_at);
+create index if not exists messages_created_idx on messages (created_at);
@@ -0,0 +1,71 @@
+import threading
+import logging
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+_registry = []
+
+
+class LazyService:
+    """
+    Module-level stand-in for a singleton that is built on first use.
+    Attribute access is forwarded to the real instance, so callers keep
+    using `model_manager.generate_stream(...)` etc. unchanged. Expensive
+    start-up work lives in the service's warm-up hook, which the app
+    lifespan runs in the background instead of at import time.
+    """
+
+    def __init__(self, name: str, factory: Callable, warmup: str = None):
+        self._name = name
+        self._factory = factory
+        self._warmup = warmup
+        self._instance = None
+        self._lock = threading.Lock()
+        self.status = "pending"
+        self.error = None
+        _registry.append(self)
+
+    def get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+        return self._instance
+
+    @property
+    def initialized(self) -> bool:
+        return self._instance is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+    def warm_up(self):
+        self.status = "warming"
+        try:
+            instance = self.get()
+            if self._warmup:
+                getattr(instance, self._warmup)()
+            self.status = "ready"
+        except Exception as e:
+            self.status = "failed"
+            self.error = str(e)
+            logger.error(f"Warm-up of {self._name} failed: {str(e)}", exc_info=True)
+
+
+def warm_up_all():
+    """Build every registered service and run its warm-up hook"""
+    for service in list(_registry):
+        service.warm_up()
+    logger.info("Service warm-up finished")
+
+
+def readiness() -> dict:
+    services = {
+        service._name: service.status if not service.error else f"{service.status}: {service.error}"
+        for service in _registry
+    }
+    return {
+        "ready": all(service.status == "ready" for service in _registry),
+        "services": services
+    }
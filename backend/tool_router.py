@@ -0,0 +1,333 @@
+import re
+import json
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Score a tool needs before it is called
+THRESHOLD = 1.0
+# What a company name or bare ticker adds to stock_price, only next to a stock or price cue
+SYMBOL_WEIGHT = 0.5
+
+CRYPTOS = {
+    "bitcoin": "bitcoin", "btc": "bitcoin", "ethereum": "ethereum", "ether": "ethereum",
+    "eth": "ethereum", "solana": "solana", "cardano": "cardano", "dogecoin": "dogecoin",
+    "doge": "dogecoin", "ripple": "ripple", "xrp": "ripple", "litecoin": "litecoin", "ltc": "litecoin"
+}
+
+COMPANIES = {
+    "apple": "AAPL", "tesla": "TSLA", "microsoft": "MSFT", "amazon": "AMZN", "google": "GOOGL",
+    "alphabet": "GOOGL", "nvidia": "NVDA", "meta": "META", "netflix": "NFLX", "ibm": "IBM",
+    "intel": "INTC", "amd": "AMD"
+}
+
+CURRENCIES = {
+    "usd": "USD", "dollar": "USD", "dollars": "USD", "eur": "EUR", "euro": "EUR", "euros": "EUR",
+    "gbp": "GBP", "pound": "GBP", "pounds": "GBP", "sterling": "GBP", "jpy": "JPY", "yen": "JPY",
+    "inr": "INR", "rupee": "INR", "rupees": "INR", "cny": "CNY", "yuan": "CNY", "chf": "CHF",
+    "franc": "CHF", "francs": "CHF", "cad": "CAD", "aud": "AUD"
+}
+CURRENCY_SYMBOLS = {"$": "USD", "€": "EUR", "£": "GBP", "¥": "JPY"}
+
+# get_time understands these abbreviations
+TIMEZONE_CODES = {
+    "utc": "UTC", "gmt": "UTC", "est": "EST", "edt": "EST", "pst": "PST", "pdt": "PST",
+    "cet": "CET", "ist": "IST", "jst": "JST", "aest": "AEST"
+}
+CITY_TIMEZONES = {
+    "tokyo": "JST", "osaka": "JST", "london": "UTC", "lisbon": "UTC", "dublin": "UTC",
+    "new york": "EST", "boston": "EST", "miami": "EST", "toronto": "EST", "washington": "EST",
+    "los angeles": "PST", "san francisco": "PST", "seattle": "PST", "vancouver": "PST",
+    "paris": "CET", "berlin": "CET", "rome": "CET", "madrid": "CET", "amsterdam": "CET",
+    "delhi": "IST", "new delhi": "IST", "mumbai": "IST", "bangalore": "IST",
+    "sydney": "AEST", "melbourne": "AEST", "brisbane": "AEST"
+}
+
+# Upper-case words that look like tickers but are not
+NOT_TICKERS = {
+    "AI", "API", "CEO", "CPU", "GPU", "USA", "US", "UK", "EU", "UN", "FAQ", "PDF", "OK", "TV", "AM",
+    "PM", "ID", "IT", "HR", "PR", "ETF", "IPO", "NASA", "HTML", "JSON", "SQL", "URL", "I", "A"
+}
+PLACE_STOPWORDS = {
+    "the", "a", "an", "my", "your", "our", "this", "that", "it", "me", "you", "us", "them", "today",
+    "tomorrow", "tonight", "now", "general", "english", "order", "example", "terms", "case", "fact"
+}
+TOPIC_STOPWORDS = {"latest", "the", "today's", "todays", "some", "any", "recent", "breaking", "top", "me", "us"}
+
+NUMBER = r"\d[\d,]*(?:\.\d+)?"
+_currency = "|".join(sorted((re.escape(name) for name in CURRENCIES), key=len, reverse=True))
+_symbols = "".join(re.escape(symbol) for symbol in CURRENCY_SYMBOLS)
+_cryptos = "|".join(sorted(CRYPTOS, key=len, reverse=True))
+_companies = "|".join(sorted(COMPANIES, key=len, reverse=True))
+_timezones = "|".join(sorted(TIMEZONE_CODES, key=len, reverse=True))
+_cities = "|".join(sorted((re.escape(city) for city in CITY_TIMEZONES), key=len, reverse=True))
+_arith = r"\(?-?\d+(?:\.\d+)?\)?"
+# Free text following a trigger: captured inside a lookahead so it is still scanned for other triggers
+_topic = r"(?=\s+(?P<{}>[^?.!,;]{{2,60}}))"
+
+
+def _number(text: str) -> float:
+    return float(text.replace(",", ""))
+
+
+def _currency_pair(m) -> Optional[dict]:
+    if m.group("cur_from"):
+        amount, source, target = m.group("cur_amount"), CURRENCIES[m.group("cur_from").lower()], m.group("cur_to")
+    else:
+        amount, source, target = m.group("cur_sym_amount"), CURRENCY_SYMBOLS[m.group("cur_sym")], m.group("cur_sym_to")
+    target = CURRENCIES[target.lower()]
+    if source == target:
+        return None
+    return {"amount": _number(amount) if amount else 1.0, "from_currency": source, "to_currency": target}
+
+
+def _ticker(m) -> Optional[dict]:
+    symbol = (m.group("ticker_sym") or m.group("ticker")).upper()
+    return None if symbol in NOT_TICKERS or symbol.lower() in CURRENCIES or symbol.lower() in TIMEZONE_CODES else {"symbol": symbol}
+
+
+def _expression(m) -> Optional[dict]:
+    expression = m.group("calc_expr")
+    # "3-4 days", "2024-05-01": ranges and dates, not subtraction
+    if re.fullmatch(r"[\d.]+(?:-[\d.]+)+", expression):
+        return None
+    return {"expression": expression.replace("×", "*").replace("÷", "/").replace("x", "*").replace("X", "*")}
+
+
+def _worded_expression(m) -> dict:
+    operators = {"plus": "+", "minus": "-", "times": "*", "multiplied by": "*", "divided by": "/", "over": "/"}
+    operator = operators[" ".join(m.group("calc_op").lower().split())]
+    return {"expression": f"{m.group('calc_a')} {operator} {m.group('calc_b')}"}
+
+
+def _place(m) -> Optional[dict]:
+    place = " ".join(m.group("place").split())
+    if place.split()[0].lower() in PLACE_STOPWORDS:
+        return None
+    return {"place": place}
+
+
+def _topic_arg(group: str, key: str = "query") -> Callable:
+    def extract(m) -> dict:
+        topic = " ".join((m.group(group) or "").split())
+        return {} if not topic or topic.lower() in TOPIC_STOPWORDS else {key: topic}
+    return extract
+
+
+# (tools scored, weight, pattern, argument extractor). The extractor returns the
+# arguments found (possibly {}), or None to discard the match. Order matters where
+# alternatives can start at the same position: more specific patterns come first.
+TRIGGERS: List[Tuple[Tuple[str, ...], float, str, Optional[Callable]]] = [
+    # Currency pairs: "100 usd to eur", "$50 in euros", "usd/jpy"
+    (("currency_convert",), 1.0,
+     rf"(?:(?P<cur_amount>{NUMBER})\s*)?\b(?P<cur_from>{_currency})\s*(?:/|\s(?:to|in|into)\s)\s*(?P<cur_to>{_currency})\b",
+     _currency_pair),
+    (("currency_convert",), 1.0,
+     rf"(?P<cur_sym>[{_symbols}])\s?(?P<cur_sym_amount>{NUMBER})\s+(?:to|in|into)\s+(?P<cur_sym_to>{_currency})\b",
+     _currency_pair),
+    (("stock_price",), 1.0, r"\$(?P<ticker_sym>[a-z]{1,5})\b", _ticker),
+
+    # Arithmetic
+    (("calculator",), 1.0, r"\bsquare\s+root\s+of\s+(?P<sqrt>\d+(?:\.\d+)?)",
+     lambda m: {"expression": f"sqrt({m.group('sqrt')})"}),
+    (("calculator",), 1.0, r"\b(?P<pct>\d+(?:\.\d+)?)\s*(?:%|percent)\s+of\s+(?P<pct_of>\d+(?:\.\d+)?)",
+     lambda m: {"expression": f"{m.group('pct')} / 100 * {m.group('pct_of')}"}),
+    (("calculator",), 1.0,
+     r"\b(?P<calc_a>\d+(?:\.\d+)?)\s+(?P<calc_op>plus|minus|times|multiplied\s+by|divided\s+by|over)\s+(?P<calc_b>\d+(?:\.\d+)?)\b",
+     _worded_expression),
+    (("calculator",), 1.0, rf"(?P<calc_expr>{_arith}(?:\s*[-+*/×÷%x]\s*{_arith})+)", _expression),
+    (("calculator",), 0.5, r"\b(?:calculate|compute|solve|evaluate)\b", None),
+
+    # Weather
+    (("weather",), 1.0,
+     r"\b(?:weather|forecast|temperature|humidity|raining|rainy|rain|snowing|snow|sunny|cloudy|windy|umbrella)\b", None),
+    (("weather",), 1.0, r"\bhow\s+(?:hot|cold|warm)\b", None),
+    (("weather",), 0.4, r"\b(?:hot|cold|warm|degrees)\b", None),
+
+    # Time
+    (("time",), 1.0, r"\b(?:what\s+time|current\s+time|time\s+now|time\s+zone|timezone|local\s+time)\b", None),
+    (("time",), 1.0, r"\btime(?=\s+(?:is\s+it\s+)?in\b)", None),
+    (("time",), 0.5, rf"\b(?P<tz>{_timezones})\b", lambda m: {"timezone": TIMEZONE_CODES[m.group("tz").lower()]}),
+
+    # News
+    (("news",), 1.0, r"\b(?:news|headlines?)\s+(?:about|on|regarding)" + _topic.format("news_topic"),
+     _topic_arg("news_topic")),
+    (("news",), 1.0, r"\b(?P<news_word>[a-z]+)\s+(?:news|headlines)\b", _topic_arg("news_word")),
+    (("news",), 1.0, r"\b(?:news|headlines?|breaking|current\s+events)\b", None),
+
+    # Reference and search
+    (("wikipedia",), 1.0, r"\b(?:wikipedia|wiki)\b", None),
+    (("wikipedia",), 1.0, r"\b(?:tell\s+me\s+about|who\s+was|history\s+of|biography\s+of|definition\s+of|define)"
+     + _topic.format("wiki_topic"), _topic_arg("wiki_topic")),
+    (("web_search",), 1.0, r"\b(?:search(?:\s+(?:for|the\s+web|online))?|look\s+up|google\s+(?:it|that|this|for))\b", None),
+    (("web_search",), 1.0, r"\bfind\s+(?:me\s+)?(?:information|info|articles?|sources?|links?|reviews?)\b", None),
+    (("web_search",), 1.0, r"\bwho\s+(?:won|is\s+the\s+(?:current|new))\b", None),
+    (("web_search",), 0.4, r"\b(?:latest|recent|recently|this\s+year|20\d\d)\b", None),
+
+    # Crypto and stocks
+    (("crypto_price",), 1.0, rf"\b(?P<crypto>{_cryptos})\b", lambda m: {"crypto": CRYPTOS[m.group("crypto").lower()]}),
+    (("crypto_price",), 1.0, r"\b(?:crypto|cryptocurrency|cryptocurrencies|altcoins?)\b", None),
+    (("stock_price",), 1.0, r"\b(?:stocks?|shares?|ticker|nasdaq|nyse|dow\s+jones|s&p)\b", None),
+    (("stock_price",), 0.7, r"\b(?:trading\s+at|market\s+cap)\b", None),
+    ((), 0.0, rf"\b(?P<company>{_companies})\b", lambda m: {"symbol": COMPANIES[m.group("company").lower()]}),
+    ((), 0.0, r"(?-i:\b(?P<ticker>[A-Z]{2,5})\b)", _ticker),
+    (("stock_price", "crypto_price"), 0.5, r"\b(?:price|prices|priced|worth|valued)\b", None),
+
+    # Currency words without a full pair only hint
+    (("currency_convert",), 0.5, r"\b(?:convert|conversion|exchange\s+rates?|forex)\b", None),
+
+    # Arguments only
+    ((), 0.0, rf"\b(?P<city>{_cities})\b", lambda m: {"city": m.group("city")}),
+    ((), 0.0, r"\b(?:in|at|for)(?=\s+(?P<place>[a-z][a-z.'-]*(?:\s+[a-z][a-z.'-]*){0,2}?)"
+              r"\s*(?:[?.!,;]|$|\b(?:today|tomorrow|tonight|now|right\s+now|currently|this|next|please)\b))",
+     _place),
+]
+
+# Tools that are useless without these arguments
+REQUIRED_ARGS = {"stock_price": "symbol", "currency_convert": "from_currency", "calculator": "expression"}
+
+
+class ToolRouter:
+    """
+    Decides which tools a chat message needs, and with what arguments.
+    All triggers are compiled into one case-insensitive alternation with word
+    boundaries and matched in a single finditer pass; each match adds its
+    weight to the tools it hints at and contributes any arguments it
+    captured. Tools scoring at least THRESHOLD with their required
+    arguments present are returned, best first.
+    """
+
+    def __init__(self, triggers=TRIGGERS, threshold: float = THRESHOLD):
+        self.threshold = threshold
+        self.entries = []
+        alternatives = []
+        for index, (tools, weight, pattern, extract) in enumerate(triggers):
+            alternatives.append(f"(?P<t{index}>{pattern})")
+            self.entries.append((tools, weight, extract))
+        self.pattern = re.compile("|".join(alternatives), re.IGNORECASE)
+
+    def analyze(self, message: str) -> Tuple[Dict[str, float], Dict[str, dict]]:
+        """Scores per tool and the arguments found, keyed by argument kind"""
+        scores = {}
+        found = {}
+        for m in self.pattern.finditer(message):
+            tools, weight, extract = self.entries[int(m.lastgroup[1:])]
+            args = extract(m) if extract else {}
+            if args is None:
+                continue
+            for tool in tools:
+                scores[tool] = scores.get(tool, 0.0) + weight
+            for key, value in args.items():
+                found.setdefault(key, value)
+        # "CSS and DOM", "HELP ME", "apple pie": names and capitals alone say nothing about stocks
+        if "symbol" in found and scores.get("stock_price"):
+            scores["stock_price"] += SYMBOL_WEIGHT
+        return scores, found
+
+    @staticmethod
+    def _args_for(tool: str, message: str, found: dict) -> dict:
+        if tool == "web_search":
+            return {"query": message}
+        if tool == "wikipedia":
+            return {"query": found.get("query", message)}
+        if tool == "news":
+            return {"query": found.get("query", "latest")}
+        if tool == "weather":
+            city = found.get("city") or found.get("place")
+            return {"city": city.title() if city else "London"}
+        if tool == "time":
+            place = (found.get("city") or found.get("place") or "").lower()
+            return {"timezone": found.get("timezone") or CITY_TIMEZONES.get(place, "UTC")}
+        if tool == "crypto_price":
+            return {"crypto": found.get("crypto", "bitcoin")}
+        if tool == "stock_price":
+            return {"symbol": found["symbol"]} if "symbol" in found else {}
+        if tool == "currency_convert":
+            keys = ("amount", "from_currency", "to_currency")
+            return {key: found[key] for key in keys if key in found}
+        if tool == "calculator":
+            return {"expression": found["expression"]} if "expression" in found else {}
+        return {}
+
+    def route(self, message: str, allowed: Optional[List[str]] = None, limit: int = 3) -> List[Tuple[str, dict]]:
+        """(tool, kwargs) calls for a message, highest score first"""
+        scores, found = self.analyze(message)
+        calls = []
+        for tool, score in sorted(scores.items(), key=lambda item: -item[1]):
+            if score < self.threshold or (allowed is not None and tool not in allowed):
+                continue
+            args = self._args_for(tool, message, found)
+            if tool in REQUIRED_ARGS and REQUIRED_ARGS[tool] not in args:
+                continue
+            calls.append((tool, args))
+        return calls[:limit]
+
+
+def load_corpus(path: str = None) -> List[dict]:
+    path = path or os.path.join(os.path.dirname(os.path.abspath(__file__)), "tool_router_corpus.jsonl")
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def evaluate(router: "ToolRouter" = None, corpus: List[dict] = None, limit: int = 3) -> dict:
+    """
+    Precision/recall of routing decisions against the labeled corpus.
+    Each corpus entry is {"message", "tools": [...], "args": {tool: {...}}};
+    "args" is optional and only the listed keys are checked.
+    """
+    router = router or tool_router
+    corpus = corpus if corpus is not None else load_corpus()
+    per_tool = {}
+    true_pos = false_pos = false_neg = exact = args_checked = args_correct = 0
+    failures = []
+
+    for case in corpus:
+        calls = dict(router.route(case["message"], limit=limit))
+        predicted, expected = set(calls), set(case["tools"])
+        true_pos += len(predicted & expected)
+        false_pos += len(predicted - expected)
+        false_neg += len(expected - predicted)
+        exact += predicted == expected
+        for tool in predicted | expected:
+            counts = per_tool.setdefault(tool, {"tp": 0, "fp": 0, "fn": 0})
+            counts["tp" if tool in predicted and tool in expected else "fp" if tool in predicted else "fn"] += 1
+
+        wrong_args = {}
+        for tool, labeled in case.get("args", {}).items():
+            for key, value in labeled.items():
+                args_checked += 1
+                actual = calls.get(tool, {}).get(key)
+                if actual == value or (isinstance(value, str) and isinstance(actual, str) and actual.lower() == value.lower()):
+                    args_correct += 1
+                else:
+                    wrong_args[f"{tool}.{key}"] = {"expected": value, "got": actual}
+        if predicted != expected or wrong_args:
+            failures.append({
+                "message": case["message"],
+                "expected": sorted(expected),
+                "predicted": sorted(predicted),
+                "wrong_args": wrong_args
+            })
+
+    def ratio(numerator, denominator):
+        return round(numerator / denominator, 3) if denominator else 1.0
+
+    return {
+        "cases": len(corpus),
+        "precision": ratio(true_pos, true_pos + false_pos),
+        "recall": ratio(true_pos, true_pos + false_neg),
+        "exact_match": ratio(exact, len(corpus)),
+        "arg_accuracy": ratio(args_correct, args_checked),
+        "per_tool": {
+            tool: {
+                "precision": ratio(c["tp"], c["tp"] + c["fp"]),
+                "recall": ratio(c["tp"], c["tp"] + c["fn"]),
+                **c
+            }
+            for tool, c in sorted(per_tool.items())
+        },
+        "failures": failures
+    }
+
+
+# Create global instance
+tool_router = ToolRouter()
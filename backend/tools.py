@@ -1,12 +1,73 @@
-import requests
+import ast
 import json
+import math
+import operator
 from typing import Any, Dict, List, Optional
 from datetime import datetime
 import os
+import time
+import threading
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from services import LazyService
+from cache import TTLCache
+from http_client import http_client
 
 logger = logging.getLogger(__name__)
 
+# Integer results are capped so "9**9**9**9" fails fast instead of holding the GIL for minutes
+CALC_MAX_BITS = 4096
+
+CALC_OPERATORS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: operator.pow,
+    ast.USub: operator.neg, ast.UAdd: operator.pos,
+}
+
+
+def _calc_check(value):
+    if isinstance(value, int) and value.bit_length() > CALC_MAX_BITS:
+        raise ValueError("result too large")
+    return value
+
+
+def _calc_pow(base, exponent):
+    # Estimate the size before computing it; only integer powers can grow without bound
+    if isinstance(base, int) and isinstance(exponent, int) and abs(base) > 1:
+        if exponent * math.log2(abs(base)) > CALC_MAX_BITS:
+            raise ValueError("result too large")
+    return _calc_check(base ** exponent)
+
+
+CALC_FUNCTIONS = {
+    'sin': math.sin, 'cos': math.cos, 'tan': math.tan, 'sqrt': math.sqrt,
+    'log': math.log, 'log10': math.log10, 'pow': _calc_pow, 'abs': abs, 'round': round,
+}
+CALC_CONSTANTS = {'pi': math.pi, 'e': math.e}
+
+
+def _calc_eval(node):
+    """Evaluate a parsed arithmetic expression, allowing numbers, operators and the math helpers only"""
+    if isinstance(node, ast.Expression):
+        return _calc_eval(node.body)
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.Name) and node.id in CALC_CONSTANTS:
+        return CALC_CONSTANTS[node.id]
+    if isinstance(node, ast.UnaryOp) and type(node.op) in CALC_OPERATORS:
+        return CALC_OPERATORS[type(node.op)](_calc_eval(node.operand))
+    if isinstance(node, ast.BinOp) and type(node.op) in CALC_OPERATORS:
+        left, right = _calc_eval(node.left), _calc_eval(node.right)
+        if isinstance(node.op, ast.Pow):
+            return _calc_pow(left, right)
+        return _calc_check(CALC_OPERATORS[type(node.op)](left, right))
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in CALC_FUNCTIONS
+            and not node.keywords):
+        return _calc_check(CALC_FUNCTIONS[node.func.id](*[_calc_eval(arg) for arg in node.args]))
+    raise ValueError(f"unsupported expression: {ast.dump(node)[:40]}")
+
 class ToolExecutor:
     """Execute external tools to provide real-time data to models"""
     
@@ -23,17 +84,102 @@ class ToolExecutor:
             "currency_convert": self.currency_convert,
             "wikipedia": self.wikipedia_search,
         }
-        
+        # Per-request HTTP timeouts (seconds); also the longest /chat waits for each tool
+        self.tool_timeouts = {
+            "web_search": 4,
+            "weather": 5,  # two hops (geocode, forecast) sharing one deadline
+            "news": 4,
+            "stock_price": 4,
+            "crypto_price": 3,
+            "time": 1,
+            "calculator": 1,
+            "url_fetch": 5,
+            "currency_convert": 3,
+            "wikipedia": 4,
+        }
+        # Shared budget for all tools of one chat message
+        self.deadline = float(os.getenv("TOOL_DEADLINE_SECONDS", "5"))
+        self.pool = ThreadPoolExecutor(
+            max_workers=int(os.getenv("TOOL_WORKERS", "16")),
+            thread_name_prefix="tool"
+        )
+        # Response freshness per tool: (ttl, stale window) in seconds. Within the
+        # stale window an expired result is still served while it is refreshed
+        # in the background. Tools not listed here are never cached.
+        self.cache_policies = {
+            "crypto_price": (30, 30),
+            "stock_price": (60, 60),
+            "weather": (600, 300),
+            "news": (300, 300),
+            "web_search": (1800, 600),
+            "url_fetch": (300, 0),
+            "currency_convert": (3600, 1800),
+            "wikipedia": (86400, 3600),
+        }
+        self.cache = TTLCache(max_entries=int(os.getenv("TOOL_CACHE_SIZE", "2048")))
+        self.refreshing = set()
+        self.refresh_lock = threading.Lock()
+
+    @staticmethod
+    def _cache_key(tool_name: str, kwargs: dict) -> str:
+        """Tool name plus arguments normalized for case and whitespace"""
+        normalized = {}
+        for key, value in kwargs.items():
+            if isinstance(value, str):
+                value = " ".join(value.split())
+                if key != "url":
+                    value = value.lower()
+            normalized[key] = value
+        return f"{tool_name}:{json.dumps(normalized, sort_keys=True, default=str)}"
+
     def execute_tool(self, tool_name: str, **kwargs) -> Dict[str, Any]:
-        """Execute a tool and return result"""
+        """Execute a tool and return result, served from cache when fresh enough"""
+        if tool_name not in self.tools:
+            return {
+                "status": "error",
+                "tool": tool_name,
+                "message": f"Tool '{tool_name}' not found"
+            }
+
+        ttl, stale_window = self.cache_policies.get(tool_name, (0, 0))
+        if not ttl:
+            return self._run_tool(tool_name, kwargs)
+
+        key = self._cache_key(tool_name, kwargs)
+        cached, state = self.cache.lookup(key, stale_window)
+        if state == "stale":
+            self._revalidate(tool_name, kwargs, key, ttl)
+        if cached is not None:
+            return dict(cached)
+
+        result = self._run_tool(tool_name, kwargs)
+        if result["status"] == "success":
+            self.cache.set(key, result, ttl)
+        return dict(result)
+
+    def _revalidate(self, tool_name: str, kwargs: dict, key: str, ttl: float):
+        """Refresh a stale cache entry in the background (once per key)"""
+        with self.refresh_lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def refresh():
+            try:
+                result = self._run_tool(tool_name, kwargs)
+                if result["status"] == "success":
+                    self.cache.set(key, result, ttl)
+            finally:
+                with self.refresh_lock:
+                    self.refreshing.discard(key)
+
+        self.pool.submit(refresh)
+
+    def get_cache_stats(self) -> Dict[str, Any]:
+        return self.cache.get_stats()
+
+    def _run_tool(self, tool_name: str, kwargs: dict) -> Dict[str, Any]:
         try:
-            if tool_name not in self.tools:
-                return {
-                    "status": "error",
-                    "tool": tool_name,
-                    "message": f"Tool '{tool_name}' not found"
-                }
-            
             logger.info(f"Executing tool: {tool_name} with args: {kwargs}")
             result = self.tools[tool_name](**kwargs)
             result["tool"] = tool_name
@@ -47,6 +193,37 @@ class ToolExecutor:
                 "message": str(e)
             }
 
+    async def execute_many_async(self, calls: List[tuple], deadline: float = None) -> Dict[str, Dict[str, Any]]:
+        """
+        Run several (tool_name, kwargs) calls concurrently on the tool pool.
+        Each tool gets min(its own timeout, the shared deadline); tools that
+        have not finished by then are reported with status "timeout" and
+        left to finish in the background. The event loop only waits.
+        """
+        deadline = deadline or self.deadline
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        futures = [
+            (tool_name, asyncio.wrap_future(self.pool.submit(self.execute_tool, tool_name, **kwargs)))
+            for tool_name, kwargs in calls
+        ]
+
+        results = {}
+        for tool_name, future in futures:
+            budget = min(self.tool_timeouts.get(tool_name, deadline), deadline)
+            try:
+                results[tool_name] = await asyncio.wait_for(
+                    asyncio.shield(future), timeout=max(0, budget - (loop.time() - start))
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"Tool {tool_name} missed its {budget}s deadline, skipping")
+                results[tool_name] = {
+                    "status": "timeout",
+                    "tool": tool_name,
+                    "message": f"Tool '{tool_name}' did not respond within {budget}s"
+                }
+        return results
+
     def web_search(self, query: str, max_results: int = 5) -> Dict[str, Any]:
         """Search the web using DuckDuckGo"""
         try:
@@ -58,11 +235,11 @@ class ToolExecutor:
                 'no_html': '1',
                 'skip_disambig': '1'
             }
-            response = requests.get(
+            response = http_client.get(
                 'https://api.duckduckgo.com/',
                 params=params,
                 headers=headers,
-                timeout=10
+                timeout=self.tool_timeouts["web_search"]
             )
             response.raise_for_status()
             data = response.json()
@@ -105,6 +282,10 @@ class ToolExecutor:
             if not clean_city or len(clean_city) < 2:
                 clean_city = "London"  # Default fallback
             
+            # Both hops and their retries share the tool's budget
+            deadline = time.monotonic() + self.tool_timeouts["weather"]
+            hop_timeout = self.tool_timeouts["weather"] * 0.6
+
             # First get coordinates from city name
             geo_params = {
                 'name': clean_city,
@@ -112,10 +293,11 @@ class ToolExecutor:
                 'language': 'en',
                 'format': 'json'
             }
-            geo_response = requests.get(
+            geo_response = http_client.get(
                 'https://geocoding-api.open-meteo.com/v1/search',
                 params=geo_params,
-                timeout=10
+                timeout=hop_timeout,
+                deadline=deadline
             )
             geo_response.raise_for_status()
             geo_data = geo_response.json()
@@ -138,10 +320,11 @@ class ToolExecutor:
                 'timezone': 'auto'
             }
             
-            weather_response = requests.get(
+            weather_response = http_client.get(
                 'https://api.open-meteo.com/v1/forecast',
                 params=weather_params,
-                timeout=10
+                timeout=hop_timeout,
+                deadline=deadline
             )
             weather_response.raise_for_status()
             weather_data = weather_response.json()
@@ -193,10 +376,10 @@ class ToolExecutor:
             
             # BBC News RSS feed (no API key needed)
             try:
-                response = requests.get(
+                response = http_client.get(
                     'https://feeds.bbci.co.uk/news/rss.xml',
                     headers=headers,
-                    timeout=10
+                    timeout=self.tool_timeouts["news"]
                 )
                 if response.status_code == 200:
                     # Parse basic XML (simplified)
@@ -242,10 +425,10 @@ class ToolExecutor:
             headers = {'User-Agent': 'Mozilla/5.0'}
             
             # Try to get from multiple sources
-            response = requests.get(
+            response = http_client.get(
                 f'https://query1.finance.yahoo.com/v10/finance/quoteSummary/{symbol}',
                 headers=headers,
-                timeout=10
+                timeout=self.tool_timeouts["stock_price"]
             )
             
             if response.status_code == 200:
@@ -281,7 +464,7 @@ class ToolExecutor:
             
             crypto_id = crypto_map.get(crypto.lower(), crypto.lower())
             
-            response = requests.get(
+            response = http_client.get(
                 f'https://api.coingecko.com/api/v3/simple/price',
                 params={
                     'ids': crypto_id,
@@ -290,7 +473,7 @@ class ToolExecutor:
                     'include_24hr_vol': 'true',
                     'include_market_cap_change_24h': 'true'
                 },
-                timeout=10
+                timeout=self.tool_timeouts["crypto_price"]
             )
             response.raise_for_status()
             data = response.json()
@@ -344,24 +527,9 @@ class ToolExecutor:
     def calculator(self, expression: str) -> Dict[str, Any]:
         """Safely evaluate mathematical expressions"""
         try:
-            import math
-            
-            # Safe evaluation with allowed functions
-            safe_dict = {
-                'sin': math.sin,
-                'cos': math.cos,
-                'tan': math.tan,
-                'sqrt': math.sqrt,
-                'pi': math.pi,
-                'e': math.e,
-                'log': math.log,
-                'log10': math.log10,
-                'pow': pow,
-                'abs': abs,
-                'round': round,
-            }
-            
-            result = eval(expression, {"__builtins__": {}}, safe_dict)
+            if len(expression) > 200:
+                raise ValueError("expression too long")
+            result = _calc_eval(ast.parse(expression, mode="eval"))
             
             return {
                 "expression": expression,
@@ -375,7 +543,7 @@ class ToolExecutor:
         """Fetch and summarize content from URL"""
         try:
             headers = {'User-Agent': 'Mozilla/5.0'}
-            response = requests.get(url, headers=headers, timeout=timeout)
+            response = http_client.get(url, headers=headers, timeout=timeout)
             response.raise_for_status()
             
             # Extract text from HTML
@@ -420,9 +588,9 @@ class ToolExecutor:
     def currency_convert(self, amount: float, from_currency: str, to_currency: str) -> Dict[str, Any]:
         """Convert between currencies using ExchangeRate-API"""
         try:
-            response = requests.get(
+            response = http_client.get(
                 f'https://api.exchangerate-api.com/v4/latest/{from_currency.upper()}',
-                timeout=10
+                timeout=self.tool_timeouts["currency_convert"]
             )
             response.raise_for_status()
             data = response.json()
@@ -447,7 +615,7 @@ class ToolExecutor:
     def wikipedia_search(self, query: str, max_results: int = 3) -> Dict[str, Any]:
         """Search Wikipedia"""
         try:
-            response = requests.get(
+            response = http_client.get(
                 'https://en.wikipedia.org/w/api.php',
                 params={
                     'action': 'query',
@@ -456,7 +624,7 @@ class ToolExecutor:
                     'format': 'json',
                     'srlimit': max_results
                 },
-                timeout=10
+                timeout=self.tool_timeouts["wikipedia"]
             )
             response.raise_for_status()
             data = response.json()
@@ -493,4 +661,4 @@ class ToolExecutor:
         }
 
 # Create global tool executor instance
-tool_executor = ToolExecutor()
+tool_executor = LazyService("tool_executor", ToolExecutor)
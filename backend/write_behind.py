@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import threading
+import logging
+from collections import deque
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """
+    Buffers rows in memory and writes them in bulk from a background thread.
+    A batch is flushed when `batch_size` rows are waiting or `flush_interval`
+    seconds have passed. Failed batches are retried with backoff and, if the
+    backend stays down, appended to a JSONL journal that is replayed once
+    writes succeed again (and at start-up). close() drains everything.
+    """
+
+    def __init__(self, write_batch: Callable, journal_path: str, batch_size: int = 50,
+                 flush_interval: float = 2.0, max_retries: int = 3, retry_backoff: float = 0.5):
+        self.write_batch = write_batch
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.buffer = deque()
+        self.cond = threading.Condition()
+        self.journal_lock = threading.Lock()
+        self.closing = False
+        self.stats = {"enqueued": 0, "written": 0, "batches": 0, "failed_attempts": 0, "spilled": 0, "replayed": 0}
+        self.worker = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self.worker.start()
+
+    def put(self, row: dict):
+        with self.cond:
+            self.buffer.append(row)
+            self.stats["enqueued"] += 1
+            if len(self.buffer) >= self.batch_size:
+                self.cond.notify()
+
+    def _take_batch(self) -> list:
+        with self.cond:
+            deadline = time.monotonic() + self.flush_interval
+            while not self.closing and len(self.buffer) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            count = min(len(self.buffer), self.batch_size)
+            return [self.buffer.popleft() for _ in range(count)]
+
+    def _run(self):
+        self._replay_journal()
+        while True:
+            batch = self._take_batch()
+            if batch:
+                self._write(batch)
+            with self.cond:
+                if self.closing and not self.buffer:
+                    return
+
+    def _write(self, batch: list) -> bool:
+        attempts = 1 if self.closing else self.max_retries
+        for attempt in range(attempts):
+            try:
+                self.write_batch(batch)
+                self.stats["written"] += len(batch)
+                self.stats["batches"] += 1
+                self._replay_journal()
+                return True
+            except Exception as e:
+                self.stats["failed_attempts"] += 1
+                logger.warning(f"Batch write of {len(batch)} rows failed (attempt {attempt + 1}): {str(e)}")
+                if attempt + 1 < attempts:
+                    time.sleep(self.retry_backoff * (2 ** attempt))
+        self._spill(batch)
+        return False
+
+    def _spill(self, rows: list):
+        with self.journal_lock:
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps(row) + "\n")
+        self.stats["spilled"] += len(rows)
+        logger.warning(f"Spilled {len(rows)} rows to {self.journal_path}")
+
+    def _replay_journal(self):
+        """
+        Re-send journaled rows. They are moved to `<journal>.replaying`, which
+        is trimmed as each batch lands and removed only once it is empty, so a
+        crash mid-replay loses nothing; a file left by an earlier crash is
+        replayed first. Rows that still fail stay there for the next attempt.
+        """
+        replaying = f"{self.journal_path}.replaying"
+        while True:
+            with self.journal_lock:
+                if not os.path.exists(replaying):
+                    if not os.path.exists(self.journal_path) or os.path.getsize(self.journal_path) == 0:
+                        return
+                    os.replace(self.journal_path, replaying)
+            with open(replaying, encoding="utf-8") as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+
+            for start in range(0, len(rows), self.batch_size):
+                batch = rows[start:start + self.batch_size]
+                try:
+                    self.write_batch(batch)
+                except Exception as e:
+                    logger.warning(f"Journal replay failed, keeping {len(rows) - start} rows: {str(e)}")
+                    return
+                self.stats["replayed"] += len(batch)
+                self._rewrite(replaying, rows[start + len(batch):])
+            os.remove(replaying)
+            logger.info(f"Replayed {len(rows)} journaled rows")
+
+    @staticmethod
+    def _rewrite(path: str, rows: list):
+        """Atomically replace `path` with the rows not yet written"""
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+        os.replace(tmp, path)
+
+    def close(self, timeout: float = 10.0):
+        """Flush whatever is buffered and stop the writer thread"""
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.worker.join(timeout)
+
+    def get_stats(self) -> dict:
+        with self.cond:
+            return {**self.stats, "buffered": len(self.buffer)}
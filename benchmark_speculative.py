@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Benchmark speculative decoding for the coder model
+Measures generation speed with and without its draft model on the same prompts.
+Run from the repo root: python benchmark_speculative.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+from model_manager import ModelManager
+
+MODEL_ID = "coder"
+MAX_TOKENS = 256
+
+# Greedy decoding, where a draft has the best chance of being accepted
+PROMPTS = [
+    "Write a Python function that checks whether a string is a palindrome.",
+    "Write a JavaScript function that debounces another function.",
+    "Explain what this does: [x * x for x in range(10) if x % 2 == 0]",
+]
+
+
+def run(speculative: bool) -> dict:
+    manager = ModelManager()
+    manager.speculative = speculative
+    manager.load_model(MODEL_ID)
+
+    tokens = 0
+    elapsed = 0.0
+    for prompt in PROMPTS:
+        start = time.perf_counter()
+        for _ in manager.generate_stream(MODEL_ID, prompt, [], max_tokens=MAX_TOKENS, temperature=0.0):
+            tokens += 1
+        elapsed += time.perf_counter() - start
+
+    result = {
+        "tokens": tokens,
+        "seconds": round(elapsed, 2),
+        "tokens_per_sec": round(tokens / elapsed, 2) if elapsed else 0.0,
+        "draft": manager.get_speculative_stats()["models"].get(MODEL_ID)
+    }
+    manager.cleanup()
+    return result
+
+
+def main():
+    print(f"Model: {MODEL_ID}, {len(PROMPTS)} prompts, max_tokens={MAX_TOKENS}\n")
+    baseline = run(speculative=False)
+    print(f"Without draft: {baseline['tokens']} tokens in {baseline['seconds']}s "
+          f"({baseline['tokens_per_sec']} tok/s)")
+
+    drafted = run(speculative=True)
+    print(f"With draft:    {drafted['tokens']} tokens in {drafted['seconds']}s "
+          f"({drafted['tokens_per_sec']} tok/s)")
+    if drafted["draft"]:
+        print(f"Draft stats:   {drafted['draft']}")
+
+    if baseline["tokens_per_sec"]:
+        print(f"\nSpeed ratio: {drafted['tokens_per_sec'] / baseline['tokens_per_sec']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
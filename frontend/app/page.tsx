@@ -122,10 +122,19 @@ export default function Home() {
   const [maxTokens, setMaxTokens] = useState(2048);
 
   const abortControllerRef = useRef<AbortController | null>(null);
+  const userIdRef = useRef<string>('');
 
   useEffect(() => {
     const saved = localStorage.getItem('chat_history');
     if (saved) setHistory(JSON.parse(saved));
+
+    // Stable per-browser id so the backend can keep this user's conversations
+    let userId = localStorage.getItem('user_id');
+    if (!userId) {
+      userId = Date.now().toString(36) + Math.random().toString(36).substr(2, 9);
+      localStorage.setItem('user_id', userId);
+    }
+    userIdRef.current = userId;
   }, []);
 
   useEffect(() => {
@@ -189,6 +198,10 @@ export default function Home() {
       timestamp: Date.now()
     };
 
+    // The chat id doubles as the backend conversation id
+    const chatId = currentChatId || Date.now().toString();
+    if (!currentChatId) setCurrentChatId(chatId);
+
     setMessages(prev => [...prev, userMessage]);
     setIsLoading(true);
     abortControllerRef.current = new AbortController();
@@ -203,6 +216,8 @@ export default function Home() {
         body: JSON.stringify({
           message: text,
           model: selectedModel,
+          user_id: userIdRef.current,
+          conversation_id: chatId,
           context,
           temperature,
           max_tokens: maxTokens
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Test script for queued image generation
+Points the image generator at a local stand-in for Ollama and checks that
+identical requests share one job, finished images are served from the
+store, and a full queue is answered with 429.
+Runs offline - no Ollama or Stable Diffusion needed.
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, 'backend')
+
+# 1x1 PNG
+PNG = ("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAADElEQVR4nGP4z8AAAAMBAQDJ/pLvAAAAAElFTkSuQmCC")
+
+
+class FakeOllama(BaseHTTPRequestHandler):
+    """/api/tags for detection, /api/generate streaming NDJSON step progress then the image"""
+    protocol_version = "HTTP/1.1"  # chunked streaming, like Ollama itself
+    generations = 0
+    step_seconds = 0.1
+
+    def do_GET(self):
+        body = b'{"models": []}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        FakeOllama.generations += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        steps = body.get("steps", 4)
+        for step in range(1, steps + 1):
+            time.sleep(self.step_seconds)
+            self._chunk({"completed": step, "total": steps, "done": False})
+        self._chunk({"image": PNG, "done": True})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _chunk(self, data: dict):
+        line = (json.dumps(data) + "\n").encode()
+        self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOllama)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+os.environ["OLLAMA_URL"] = f"http://127.0.0.1:{server.server_port}"
+os.environ["IMAGE_HEALTH_INTERVAL_SECONDS"] = "0"
+# Keep the app's own stores out of the working tree when main is imported
+scratch = tempfile.mkdtemp()
+os.environ.setdefault("IMAGE_STORE_DIR", os.path.join(scratch, "images"))
+os.environ.setdefault("RESPONSE_CACHE_DIR", os.path.join(scratch, "response_cache"))
+
+from image_generator import ImageGenerator
+from image_store import ImageStore
+from image_jobs import ImageJobQueue, ImageQueueFullError
+
+
+def make_queue(directory, max_queue=4):
+    return ImageJobQueue(ImageGenerator(), ImageStore(directory, 10 * 1024 * 1024), workers=1, max_queue=max_queue)
+
+
+def test_dedupe_and_store():
+    """Identical requests share one job; a repeat after it finished comes from the store"""
+    print("🧪 Job deduplication and stored results")
+    FakeOllama.generations = 0
+    with tempfile.TemporaryDirectory() as directory:
+        queue = make_queue(directory)
+        first, first_deduplicated = queue.submit("a red fox", 64, 64, 4)
+        second, second_deduplicated = queue.submit("a red fox", 64, 64, 4)
+        assert first is second and not first_deduplicated and second_deduplicated
+
+        first.future.result(timeout=10)
+        print(f"   Status {first.status}, generated {FakeOllama.generations} time(s), result {first.result['image_url'][:20]}...")
+        assert first.status == "done", first.to_dict()
+        assert FakeOllama.generations == 1
+        assert first.result["image_key"] == queue.store.key("a red fox", 64, 64, 4, "ollama")
+        assert not first.result["cached"]
+        assert queue.store.lookup(first.result["image_key"])
+
+        repeat, _ = queue.submit("a red fox", 64, 64, 4)
+        repeat.future.result(timeout=10)
+        assert repeat is not first and repeat.result["cached"], repeat.to_dict()
+        assert FakeOllama.generations == 1, "stored image was generated again"
+        print(f"   Stats: {queue.get_stats()}")
+        queue.shutdown()
+    print("   ✅ PASS: one generation for three requests")
+
+
+def test_progress_reported():
+    """Ollama's step counts become job progress snapshots"""
+    print("\n🧪 Progress snapshots")
+    with tempfile.TemporaryDirectory() as directory:
+        queue = make_queue(directory)
+        job, _ = queue.submit("a blue whale", 64, 64, 4)
+        seen = set()
+        while not job.finished:
+            seen.add(job.progress)
+            time.sleep(0.02)
+        print(f"   Progress values seen: {sorted(seen)}")
+        assert len(seen - {0.0}) >= 2, seen
+        queue.shutdown()
+    print("   ✅ PASS: progress reported while generating")
+
+
+def test_queue_full():
+    """Beyond max_queue distinct jobs, submit raises and the API answers 429"""
+    print("\n🧪 Full queue")
+    with tempfile.TemporaryDirectory() as directory:
+        queue = make_queue(directory, max_queue=2)
+        queue.submit("prompt one", 64, 64, 8)
+        queue.submit("prompt two", 64, 64, 8)
+        rejected = False
+        try:
+            queue.submit("prompt three", 64, 64, 8)
+        except ImageQueueFullError as e:
+            rejected = True
+            print(f"   Rejected: {e}")
+        assert rejected, "third job was accepted"
+
+        from fastapi.testclient import TestClient
+        import main
+        main.image_jobs = queue
+        response = TestClient(main.app).post("/image-jobs", json={"prompt": "prompt four", "width": 64, "height": 64})
+        print(f"   POST /image-jobs -> {response.status_code}")
+        assert response.status_code == 429, response.text
+        queue.shutdown()
+    print("   ✅ PASS: saturated queue answers 429")
+
+
+if __name__ == "__main__":
+    print("\n🚀 Image Job Queue Test Suite\n")
+    passed = True
+    for test in (test_dedupe_and_store, test_progress_reported, test_queue_full):
+        try:
+            test()
+        except AssertionError as e:
+            print(f"   ❌ FAIL: {e}")
+            passed = False
+    server.shutdown()
+    print("\n✨ Test suite completed!")
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Test script for write-behind message persistence
+Drives DatabaseManager with an in-memory stand-in for the Supabase client:
+batched inserts, spilling to the journal while the database is down, and
+replaying the journal once it is back (and at start-up).
+Runs offline - no Supabase project needed.
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+
+sys.path.insert(0, 'backend')
+from database import DatabaseManager
+
+
+class FakeSupabase:
+    """Just enough of the supabase client for table("messages").insert(rows).execute()"""
+
+    def __init__(self):
+        self.rows = []
+        self.inserts = 0
+        self.down = False
+
+    def table(self, name):
+        return FakeInsert(self)
+
+
+class FakeInsert:
+    def __init__(self, client):
+        self.client = client
+        self.pending = []
+
+    def insert(self, rows):
+        self.pending = rows if isinstance(rows, list) else [rows]
+        return self
+
+    def execute(self):
+        if self.client.down:
+            raise ConnectionError("503 Service Unavailable")
+        self.client.inserts += 1
+        self.client.rows.extend(self.pending)
+
+
+def make_manager(client, journal_path):
+    os.environ["MESSAGE_JOURNAL_PATH"] = journal_path
+    os.environ["MESSAGE_FLUSH_SECONDS"] = "0.1"
+    manager = DatabaseManager(client=client)
+    manager.writer.retry_backoff = 0.01
+    return manager
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+
+def test_batched_inserts():
+    """Messages queued together land in one insert, with conversation ids and timestamps"""
+    print("🧪 Batched inserts")
+    client = FakeSupabase()
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = make_manager(client, os.path.join(tmp, "journal.jsonl"))
+        for i in range(5):
+            manager.enqueue_message("user-1", "user", f"message {i}", "fast-chat", "chat-1")
+        manager.shutdown()
+
+    print(f"   {len(client.rows)} rows in {client.inserts} insert(s)")
+    assert client.inserts == 1, client.inserts
+    assert [row["content"] for row in client.rows] == [f"message {i}" for i in range(5)]
+    assert all(row["conversation_id"] == "chat-1" and row["created_at"] for row in client.rows)
+    print("   ✅ PASS: one insert for the whole batch")
+
+
+def test_journal_replay_after_failed_flush():
+    """Rows that could not be written are journaled and replayed once writes succeed (created_at keeps their order)"""
+    print("\n🧪 Journal replay after a failed flush")
+    client = FakeSupabase()
+    client.down = True
+    with tempfile.TemporaryDirectory() as tmp:
+        journal = os.path.join(tmp, "journal.jsonl")
+        manager = make_manager(client, journal)
+        manager.enqueue_message("user-1", "user", "first", "fast-chat", "chat-1")
+        manager.enqueue_message("user-1", "assistant", "second", "fast-chat", "chat-1")
+        assert wait_for(lambda: manager.get_write_stats()["spilled"] == 2), manager.get_write_stats()
+        with open(journal) as f:
+            print(f"   Database down: {len(f.readlines())} rows journaled")
+
+        client.down = False
+        manager.enqueue_message("user-1", "user", "third", "fast-chat", "chat-1")
+        assert wait_for(lambda: len(client.rows) == 3), client.rows
+        manager.shutdown()
+        stats = manager.get_write_stats()
+        leftovers = [name for name in os.listdir(tmp) if name.startswith("journal")]
+
+    print(f"   Database back: stored {[row['content'] for row in client.rows]}, replayed {stats['replayed']}")
+    assert sorted(row["content"] for row in client.rows) == ["first", "second", "third"]
+    assert stats["replayed"] == 2, stats
+    assert leftovers == [], leftovers
+    print("   ✅ PASS: journaled rows written once the database recovered")
+
+
+def test_replay_on_startup():
+    """A journal left by an earlier process is replayed when the writer starts"""
+    print("\n🧪 Journal replay at start-up")
+    client = FakeSupabase()
+    with tempfile.TemporaryDirectory() as tmp:
+        journal = os.path.join(tmp, "journal.jsonl")
+        with open(journal, "w") as f:
+            for i in range(3):
+                f.write(json.dumps({"user_id": "user-1", "role": "user", "content": f"old {i}"}) + "\n")
+        manager = make_manager(client, journal)
+        assert wait_for(lambda: len(client.rows) == 3), client.rows
+        manager.shutdown()
+        assert not os.path.exists(journal) and not os.path.exists(journal + ".replaying")
+
+    assert [row["content"] for row in client.rows] == ["old 0", "old 1", "old 2"]
+    print("   ✅ PASS: leftover journal replayed")
+
+
+if __name__ == "__main__":
+    print("\n🚀 Message Persistence Test Suite\n")
+    passed = True
+    for test in (test_batched_inserts, test_journal_replay_after_failed_flush, test_replay_on_startup):
+        try:
+            test()
+        except AssertionError as e:
+            print(f"   ❌ FAIL: {e}")
+            passed = False
+    print("\n✨ Test suite completed!")
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Test script for the model downloader
+Serves a fake model file from a local HTTP server (byte ranges, optional
+X-Linked-Etag checksum) and checks resume and SHA256 verification.
+Runs offline - no Hugging Face access needed.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, 'backend')
+from model_downloader import ModelDownloader, ChecksumError
+
+BLOB = os.urandom(300 * 1024)
+BLOB_SHA256 = hashlib.sha256(BLOB).hexdigest()
+SEGMENT = 64 * 1024
+
+
+class FakeModelServer(BaseHTTPRequestHandler):
+    """Range-capable file server; `fail_from` makes ranges past that offset fail"""
+    etag = None
+    fail_from = None
+    ranges = []
+
+    def do_GET(self):
+        start, end = 0, len(BLOB) - 1
+        header = self.headers.get("Range")
+        if header:
+            first, last = header.removeprefix("bytes=").split("-")
+            start, end = int(first), min(int(last), len(BLOB) - 1)
+            if end > 0:
+                FakeModelServer.ranges.append(start)
+            if self.fail_from is not None and start >= self.fail_from:
+                self.send_error(404)
+                return
+        body = BLOB[start:end + 1]
+        self.send_response(206 if header else 200)
+        if header:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(BLOB)}")
+        if self.etag:
+            self.send_header("X-Linked-Etag", f'"{self.etag}"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeModelServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/model.gguf"
+
+
+def make_downloader(models_dir):
+    downloader = ModelDownloader(models_dir)
+    downloader.segment_size = SEGMENT
+    downloader.workers = 1  # segments in order, so the failure point is predictable
+    return downloader
+
+
+def test_resume_after_partial_download():
+    """An interrupted download keeps its finished segments and fetches only the rest"""
+    print("🧪 Resume after a partial download")
+    server, url = start_server()
+    FakeModelServer.etag, FakeModelServer.ranges = BLOB_SHA256, []
+    FakeModelServer.fail_from = 2 * SEGMENT
+    try:
+        with tempfile.TemporaryDirectory() as models_dir:
+            failed = False
+            try:
+                make_downloader(models_dir).ensure(url, "model.gguf")
+            except Exception as e:
+                failed = True
+                print(f"   First attempt failed as intended: {type(e).__name__}")
+            assert failed, "download should have failed part-way"
+
+            with open(os.path.join(models_dir, "model.gguf.part.json")) as f:
+                done = sorted(json.load(f)["done"])
+            print(f"   Segments on disk: {done}")
+            assert done == [0, SEGMENT], done
+
+            FakeModelServer.fail_from, FakeModelServer.ranges = None, []
+            path = make_downloader(models_dir).ensure(url, "model.gguf")
+            fetched = sorted(start for start in FakeModelServer.ranges if start)
+            print(f"   Second attempt fetched segments: {fetched}")
+            assert fetched == [2 * SEGMENT, 3 * SEGMENT, 4 * SEGMENT], fetched
+            with open(path, "rb") as f:
+                assert f.read() == BLOB
+            assert not os.path.exists(path + ".part")
+        print("   ✅ PASS: resumed and verified")
+    finally:
+        server.shutdown()
+
+
+def test_sha256_mismatch():
+    """A file that does not match the published SHA256 is rejected and removed"""
+    print("\n🧪 SHA256 mismatch")
+    server, url = start_server()
+    FakeModelServer.etag, FakeModelServer.fail_from = "0" * 64, None
+    try:
+        with tempfile.TemporaryDirectory() as models_dir:
+            rejected = False
+            try:
+                make_downloader(models_dir).ensure(url, "model.gguf")
+            except ChecksumError as e:
+                rejected = True
+                print(f"   Rejected: {str(e)[:60]}...")
+            assert rejected, "mismatching download was accepted"
+            leftovers = [name for name in os.listdir(models_dir) if name.startswith("model.gguf")]
+            assert leftovers == [], leftovers
+        print("   ✅ PASS: mismatch rejected, nothing left behind")
+    finally:
+        server.shutdown()
+
+
+def test_published_sha256_recorded():
+    """A verified download is recorded so the next start skips the hash"""
+    print("\n🧪 Published SHA256 recorded in the manifest")
+    server, url = start_server()
+    FakeModelServer.etag, FakeModelServer.fail_from = BLOB_SHA256, None
+    try:
+        with tempfile.TemporaryDirectory() as models_dir:
+            make_downloader(models_dir).ensure(url, "model.gguf")
+            with open(os.path.join(models_dir, "manifest.json")) as f:
+                entry = json.load(f)["model.gguf"]
+            assert entry == {"sha256": BLOB_SHA256, "size": len(BLOB)}, entry
+
+            FakeModelServer.ranges = []
+            make_downloader(models_dir).ensure(url, "model.gguf")
+            assert FakeModelServer.ranges == [], "cached file was fetched again"
+        print("   ✅ PASS: manifest entry written and reused")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    print("\n🚀 Model Downloader Test Suite\n")
+    passed = True
+    for test in (test_resume_after_partial_download, test_sha256_mismatch, test_published_sha256_recorded):
+        try:
+            test()
+        except AssertionError as e:
+            print(f"   ❌ FAIL: {e}")
+            passed = False
+    print("\n✨ Test suite completed!")
+    sys.exit(0 if passed else 1)
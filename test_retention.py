@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Test script for message retention
+Runs RetentionEngine over DatabaseManager.delete_expired_batch with an
+in-memory stand-in for the Supabase client, and checks batch sizes and
+policy precedence (user over model over default).
+Runs offline - no Supabase project needed.
+"""
+
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, 'backend')
+from database import DatabaseManager
+from retention import RetentionEngine
+
+
+class FakeResult:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeQuery:
+    """The select/delete query builder calls delete_expired_batch makes"""
+
+    def __init__(self, client):
+        self.client = client
+        self.filters = []
+        self.deleting = False
+        self.negate = False
+        self.order_by = None
+        self.count = None
+
+    def select(self, columns):
+        return self
+
+    def delete(self):
+        self.deleting = True
+        return self
+
+    @property
+    def not_(self):
+        self.negate = True
+        return self
+
+    def lt(self, column, value):
+        self.filters.append(lambda row: row[column] < value)
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row[column] == value)
+        return self
+
+    def in_(self, column, values):
+        negate, self.negate = self.negate, False
+        self.filters.append(lambda row: (row[column] in values) != negate)
+        return self
+
+    def order(self, column, desc=False):
+        self.order_by = (column, desc)
+        return self
+
+    def limit(self, count):
+        self.count = count
+        return self
+
+    def execute(self):
+        rows = [row for row in self.client.rows if all(match(row) for match in self.filters)]
+        if self.deleting:
+            self.client.delete_sizes.append(len(rows))
+            self.client.rows = [row for row in self.client.rows if row not in rows]
+            return FakeResult(rows)
+        if self.order_by:
+            rows.sort(key=lambda row: row[self.order_by[0]], reverse=self.order_by[1])
+        return FakeResult([{"id": row["id"]} for row in rows[:self.count]])
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.rows = []
+        self.delete_sizes = []
+
+    def table(self, name):
+        return FakeQuery(self)
+
+    def add(self, count, days_old, user_id="user-1", model_used="fast-chat"):
+        created = (datetime.now(timezone.utc) - timedelta(days=days_old)).isoformat()
+        for _ in range(count):
+            self.rows.append({
+                "id": len(self.rows) + 1, "user_id": user_id, "model_used": model_used, "created_at": created
+            })
+
+
+def make_db(client, tmp):
+    os.environ["MESSAGE_JOURNAL_PATH"] = os.path.join(tmp, "journal.jsonl")
+    return DatabaseManager(client=client)
+
+
+def test_batched_delete():
+    """Expired rows go in bounded batches; fresh rows stay"""
+    print("🧪 Batched retention delete")
+    client = FakeSupabase()
+    client.add(1200, days_old=2)
+    client.add(10, days_old=0)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = make_db(client, tmp)
+        result = RetentionEngine(db, {"default_days": 1}, batch_size=500, pause=0).run()
+        db.shutdown()
+
+    print(f"   Deleted {result['deleted']} in batches of {client.delete_sizes}, {len(client.rows)} rows left")
+    assert result["deleted"] == 1200 and result["complete"], result
+    assert client.delete_sizes == [500, 500, 200], client.delete_sizes
+    assert len(client.rows) == 10
+    print("   ✅ PASS: three bounded batches, fresh rows kept")
+
+
+def test_policy_precedence():
+    """A per-user retention overrides a per-model one, which overrides the default"""
+    print("\n🧪 Retention policy precedence")
+    client = FakeSupabase()
+    client.add(1, days_old=10, user_id="vip", model_used="coder")   # user policy (30 days): kept
+    client.add(1, days_old=3, model_used="coder")                   # model policy (7 days): kept
+    client.add(1, days_old=10, model_used="coder")                  # model policy: deleted
+    client.add(1, days_old=2)                                       # default (1 day): deleted
+    with tempfile.TemporaryDirectory() as tmp:
+        db = make_db(client, tmp)
+        policies = {"default_days": 1, "users": {"vip": 30}, "models": {"coder": 7}}
+        result = RetentionEngine(db, policies, batch_size=500, pause=0).run()
+        db.shutdown()
+
+    print(f"   By policy: {result['by_policy']}")
+    assert result["by_policy"] == {"user:vip": 0, "model:coder": 1, "default": 1}, result["by_policy"]
+    assert sorted(row["id"] for row in client.rows) == [1, 2]
+    print("   ✅ PASS: each message judged by its most specific policy")
+
+
+def test_time_budget():
+    """A run that exceeds max_seconds stops and reports itself incomplete"""
+    print("\n🧪 Retention time budget")
+    client = FakeSupabase()
+    client.add(50, days_old=2)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = make_db(client, tmp)
+        result = RetentionEngine(db, {"default_days": 1}, batch_size=10, pause=0.05, max_seconds=0.1).run()
+        db.shutdown()
+
+    print(f"   Deleted {result['deleted']} of 50 before the budget ran out")
+    assert not result["complete"] and 0 < result["deleted"] < 50, result
+    print("   ✅ PASS: run stopped at its time budget")
+
+
+if __name__ == "__main__":
+    print("\n🚀 Retention Test Suite\n")
+    passed = True
+    for test in (test_batched_delete, test_policy_precedence, test_time_budget):
+        try:
+            test()
+        except AssertionError as e:
+            print(f"   ❌ FAIL: {e}")
+            passed = False
+    print("\n✨ Test suite completed!")
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Test script to measure tool routing precision
+Runs the /chat tool router over the labeled corpus (backend/tool_router_corpus.jsonl)
+and compares it with the old keyword lists. Runs offline - no server needed.
+"""
+
+import sys
+import time
+
+sys.path.insert(0, 'backend')
+from tool_router import tool_router, evaluate, load_corpus
+
+# The substring matching /chat used before the router, kept as a baseline
+LEGACY_KEYWORDS = {
+    "web_search": ["search", "look up", "find", "google", "what is", "who is", "latest", "how"],
+    "weather": ["weather", "temperature", "forecast", "rain", "sunny", "climate", "cloudy", "hot", "cold", "degree"],
+    "news": ["news", "headlines", "today", "current events", "breaking", "updates"],
+    "stock_price": ["stock", "price", "$", "market", "trading", "share"],
+    "crypto_price": ["bitcoin", "ethereum", "crypto", "digital", "btc", "eth", "coin", "price"],
+    "time": ["time", "what time", "current time", "timezone", "tokyo", "london", "newyork", "paris", "sydney", "moscow"],
+    "calculator": ["calculate", "math", "solve", "equation", "plus", "minus", "multiply", "divide", "number"],
+    "currency_convert": ["convert", "exchange", "currency", "dollar", "euro", "pound", "yen"],
+    "wikipedia": ["wiki", "wikipedia", "learn about", "tell me about", "definition"]
+}
+
+
+class LegacyRouter:
+    def route(self, message, allowed=None, limit=3):
+        message_lower = message.lower()
+        tools = [tool for tool, keywords in LEGACY_KEYWORDS.items() if any(k in message_lower for k in keywords)]
+        return [(tool, {}) for tool in tools[:limit]]
+
+
+def print_report(name, report):
+    print(f"\n📊 {name}")
+    print("-" * 60)
+    print(f"   Cases:        {report['cases']}")
+    print(f"   Precision:    {report['precision']:.1%}")
+    print(f"   Recall:       {report['recall']:.1%}")
+    print(f"   Exact match:  {report['exact_match']:.1%}")
+    print(f"   Arg accuracy: {report['arg_accuracy']:.1%}")
+
+
+def test_router_corpus():
+    """Every corpus message routes to exactly its labeled tools and arguments"""
+    print("🧪 Testing Tool Router\n")
+    print("=" * 60)
+
+    corpus = load_corpus()
+    report = evaluate(tool_router, corpus)
+    print_report("Tool router", report)
+
+    print("\n   Per tool:")
+    for tool, stats in report["per_tool"].items():
+        print(f"   {tool:18} precision {stats['precision']:.0%}  recall {stats['recall']:.0%}  (tp {stats['tp']}, fp {stats['fp']}, fn {stats['fn']})")
+
+    if report["failures"]:
+        print(f"\n⚠️  {len(report['failures'])} misrouted messages:")
+        for failure in report["failures"]:
+            print(f"   • {failure['message']}")
+            print(f"     expected {failure['expected']}, got {failure['predicted']}")
+            for arg, detail in failure["wrong_args"].items():
+                print(f"     {arg}: expected {detail['expected']!r}, got {detail['got']!r}")
+    else:
+        print("\n✅ PASS: every corpus message routed correctly")
+
+    legacy = evaluate(LegacyRouter(), corpus)
+    print_report("Legacy keyword matching (baseline)", legacy)
+    assert not report["failures"], f"{len(report['failures'])} corpus messages misrouted"
+
+
+def test_router_speed():
+    """Routing cost per message"""
+    print("\n\n⏱️  Testing Routing Speed\n")
+    print("=" * 60)
+
+    messages = [case["message"] for case in load_corpus()]
+    rounds = 200
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for message in messages:
+            tool_router.route(message)
+    elapsed = time.perf_counter() - start
+    print(f"   {rounds * len(messages)} messages in {elapsed:.2f}s "
+          f"({elapsed / (rounds * len(messages)) * 1e6:.1f} µs per message)")
+
+
+if __name__ == "__main__":
+    print("\n🚀 Tool Router Test Suite\n")
+
+    passed = True
+    try:
+        test_router_corpus()
+    except AssertionError as e:
+        print(f"\n❌ FAIL: {e}")
+        passed = False
+    test_router_speed()
+
+    print("\n\n✨ Test suite completed!")
+    sys.exit(0 if passed else 1)